@@ -0,0 +1,52 @@
+"""
+Compare two result files from benchmarks/run.py.
+
+Prints the change in median time for every operation found in both files, and
+exits with an error if any of them got slower by more than --threshold.
+
+    python benchmarks/compare.py BEFORE.json AFTER.json [--threshold 1.2]
+"""
+
+import json
+import sys
+
+import click
+
+
+def _medians(f):
+    results = json.load(f)["results"]
+    return {(r["operation"], r["cache"]): r["median"] for r in results}
+
+
+@click.command()
+@click.argument("before", type=click.File())
+@click.argument("after", type=click.File())
+@click.option(
+    "--threshold",
+    type=float,
+    default=1.2,
+    help="How many times slower an operation may get before it is a regression",
+)
+def main(before, after, threshold):
+    old = _medians(before)
+    new = _medians(after)
+    regressed = False
+    for key in sorted(set(old) & set(new)):
+        ratio = new[key] / old[key] if old[key] else float("inf")
+        slower = ratio > threshold
+        regressed = regressed or slower
+        click.echo(
+            "{:<20} {:<5} {:8.1f}ms -> {:8.1f}ms  x{:.2f}{}".format(
+                key[0],
+                key[1],
+                old[key] * 1000,
+                new[key] * 1000,
+                ratio,
+                "  REGRESSION" if slower else "",
+            )
+        )
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
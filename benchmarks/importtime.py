@@ -0,0 +1,97 @@
+"""
+Check that jerjerrod's entry points still start up quickly.
+
+The powerline segments and most CLI commands only read cached records, so
+importing them must not pull in the modules which are only needed to inspect
+repos. Each entry point is imported in a fresh interpreter with
+`python -X importtime`; the script fails if a forbidden module was imported or
+the import took longer than its budget.
+
+    python benchmarks/importtime.py [--scale 2.0]
+
+.github/workflows/importtime.yml runs this on every push and pull request.
+"""
+
+import json
+import subprocess
+import sys
+
+import click
+
+# module => (budget in milliseconds, modules it must not import)
+ENTRY_POINTS = {
+    "jerjerrod.powerline": (
+        100,
+        [
+            "git",
+            "asyncio",
+            "subprocess",
+            "concurrent.futures",
+            "sqlite3",
+            "socketserver",
+            "click",
+        ],
+    ),
+    "jerjerrod.cli.entrypoint": (
+        150,
+        ["git", "asyncio", "concurrent.futures", "sqlite3", "socketserver"],
+    ),
+}
+
+# how many times each entry point is imported; the fastest import is used
+RUNS = 5
+
+_CHECK = "import sys, json, {module}; print(json.dumps(sorted(sys.modules)))"
+
+
+def importtime(module, forbidden):
+    """
+    Returns how long it took to import *module* in milliseconds, and which of
+    the *forbidden* modules it imported.
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _CHECK.format(module=module)],
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    loaded = set(json.loads(proc.stdout))
+    cumulative = None
+    for line in proc.stderr.decode("utf-8").splitlines():
+        parts = [part.strip() for part in line.split("|")]
+        if len(parts) == 3 and parts[2] == module:
+            cumulative = int(parts[1]) / 1000
+    if cumulative is None:
+        raise Exception("Couldn't find the import time of {}".format(module))
+    return cumulative, [name for name in forbidden if name in loaded]
+
+
+@click.command()
+@click.option(
+    "--scale",
+    type=float,
+    default=1.0,
+    help="Multiply every budget by this much, e.g. on slow machines.",
+)
+def main(scale):
+    failed = False
+    for module, (budget, forbidden) in ENTRY_POINTS.items():
+        best = None
+        for _ in range(RUNS):
+            elapsed, imported = importtime(module, forbidden)
+            best = elapsed if best is None else min(best, elapsed)
+        limit = budget * scale
+        ok = best <= limit and not imported
+        failed = failed or not ok
+        click.echo(
+            "{} {}: {:.1f}ms (budget {:.0f}ms)".format(
+                "OK  " if ok else "FAIL", module, best, limit
+            )
+        )
+        if imported:
+            click.echo("     imported {}".format(", ".join(imported)))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
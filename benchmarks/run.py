@@ -0,0 +1,194 @@
+"""
+Time jerjerrod against a synthetic workspace and print the results as JSON.
+
+Each operation runs in a fresh process using the HOME from synthetic.py, once
+with an empty cache ("cold") and once after the cache has been filled
+("warm"). CLI commands are timed from the outside, so their times include
+interpreter startup; library calls are timed inside the process.
+
+    python benchmarks/run.py [--home DIR] [--repos 50] [--runs 5] [-o results.json]
+
+Results from two versions can be compared with benchmarks/compare.py.
+"""
+
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from os.path import join
+
+import click
+
+from synthetic import SINGLE, WORKSPACE, environ, generate
+
+ALLSTATUSES = [
+    "JERJERROD:CHANGED",
+    "JERJERROD:UNTRACKED",
+    "JERJERROD:UNPUSHED",
+    "JERJERROD:UNKNOWN",
+]
+
+# library calls print how long they took in seconds
+_WSNAMES = """
+import time
+start = time.perf_counter()
+from jerjerrod import powerline
+for category in {categories!r}:
+    powerline.wsnames(None, category)
+print(time.perf_counter() - start)
+"""
+
+_GET_ALL_PROJECTS = """
+import time
+start = time.perf_counter()
+from jerjerrod.caching import getsharedcache
+from jerjerrod.projects import get_all_projects
+for project in get_all_projects(getsharedcache(), {}):
+    project.getrepos()
+print(time.perf_counter() - start)
+"""
+
+# also checks that every project was actually inspected
+_SCANNER = """
+import time
+start = time.perf_counter()
+from jerjerrod.scanner import Scanner
+scanner = Scanner(jobs={jobs})
+scanner.refresh()
+elapsed = time.perf_counter() - start
+records = scanner.snapshot().values()
+unknown = [r["name"] for r in records if r["status"] == "JERJERROD:UNKNOWN"]
+if unknown:
+    raise SystemExit("Scanner didn't inspect " + ", ".join(unknown))
+print(elapsed)
+"""
+
+
+def _cli(*args):
+    return [sys.executable, "-m", "jerjerrod.cli.entrypoint"] + list(args)
+
+
+def _python(code):
+    return [sys.executable, "-c", code]
+
+
+# name => (command, whether the command prints its own elapsed time)
+OPERATIONS = {
+    "namesbystatus": (_cli("namesbystatus", "--no-daemon", *ALLSTATUSES), False),
+    "summary": (_cli("summary", "--no-daemon", WORKSPACE), False),
+    "summary-single": (_cli("summary", "--no-daemon", SINGLE), False),
+    "wsnames": (_python(_WSNAMES.format(categories=ALLSTATUSES)), True),
+    "get_all_projects": (_python(_GET_ALL_PROJECTS), True),
+    "scanner": (_python(_SCANNER.format(jobs=8)), True),
+    "scanner-serial": (_python(_SCANNER.format(jobs=1)), True),
+}
+
+
+def clearcache(home):
+    shutil.rmtree(join(home, ".cache"), ignore_errors=True)
+
+
+def timeit(command, selftimed, env):
+    start = time.perf_counter()
+    proc = subprocess.run(
+        command, env=env, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    elapsed = time.perf_counter() - start
+    if selftimed:
+        elapsed = float(proc.stdout.decode("utf-8").split()[-1])
+    return elapsed
+
+
+def measure(home, name, cache, runs):
+    command, selftimed = OPERATIONS[name]
+    env = environ(home)
+    times = []
+    for _ in range(runs):
+        if cache == "cold":
+            clearcache(home)
+        else:
+            # make sure the cache has been filled by this same operation
+            timeit(command, selftimed, env)
+        times.append(timeit(command, selftimed, env))
+    return {
+        "operation": name,
+        "cache": cache,
+        "runs": times,
+        "min": min(times),
+        "median": statistics.median(times),
+        "max": max(times),
+    }
+
+
+def _version():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "describe", "--always", "--dirty"],
+                cwd=root,
+                stderr=subprocess.DEVNULL,
+            )
+            .decode("utf-8")
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@click.option(
+    "--home",
+    type=click.Path(file_okay=False),
+    help="Where to build the synthetic HOME. Defaults to a temporary folder.",
+)
+@click.option("--repos", type=int, default=50, help="How many git repos to create")
+@click.option("--files", type=int, default=20, help="How many files each repo has")
+@click.option("--hg", is_flag=True, help="Also create as many hg repos")
+@click.option("--runs", type=int, default=5, help="How many times to time each case")
+@click.option(
+    "--operation",
+    "operations",
+    type=click.Choice(sorted(OPERATIONS)),
+    multiple=True,
+    help="Only time these operations",
+)
+@click.option("-o", "--output", type=click.File("w"), default="-")
+def main(home, repos, files, hg, runs, operations, output):
+    tmpdir = None
+    if home is None:
+        home = tmpdir = tempfile.mkdtemp(prefix="jerjerrod-bench-")
+    try:
+        home = generate(home, repos, files, hg)
+        results = [
+            measure(home, name, cache, runs)
+            for name in operations or OPERATIONS
+            for cache in ("cold", "warm")
+        ]
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    json.dump(
+        {
+            "version": _version(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repos": repos,
+            "files": files,
+            "hg": hg,
+            "results": results,
+        },
+        output,
+        indent=2,
+    )
+    output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
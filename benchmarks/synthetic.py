@@ -0,0 +1,173 @@
+"""
+Generate a synthetic HOME for benchmarking jerjerrod.
+
+The HOME contains a jerjerrod.conf with one workspace of *repos* git repos
+(plus optional hg repos) and one single project. Every repo gets a bare
+"remote" under ~/remotes, and the repos cycle through the states jerjerrod
+reports on: clean, changed, untracked, stashed, ahead of their upstream, and
+holding a local-only branch.
+
+    python benchmarks/synthetic.py DEST [--repos 50] [--files 20] [--hg]
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+from os.path import join
+
+import click
+
+# the state each repo is left in, assigned in turn
+KINDS = ["clean", "changed", "untracked", "stashed", "ahead", "localbranch"]
+
+WORKSPACE = "ws"
+SINGLE = "single"
+
+_GITENV = {
+    "GIT_AUTHOR_NAME": "jerjerrod",
+    "GIT_AUTHOR_EMAIL": "jerjerrod@example.com",
+    "GIT_COMMITTER_NAME": "jerjerrod",
+    "GIT_COMMITTER_EMAIL": "jerjerrod@example.com",
+    "GIT_CONFIG_GLOBAL": os.devnull,
+    "GIT_CONFIG_NOSYSTEM": "1",
+}
+
+
+def _run(args, cwd):
+    subprocess.run(
+        args,
+        cwd=cwd,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        env=dict(os.environ, **_GITENV),
+    )
+
+
+def _write(path, contents):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(contents)
+
+
+def _commit(path, message):
+    _run(["git", "add", "--all"], path)
+    _run(["git", "commit", "--quiet", "--message", message], path)
+
+
+def makegitrepo(path, remotes, kind, files):
+    """Create a git repo at *path* with a bare remote, and leave it in *kind*"""
+    name = os.path.basename(path)
+    _run(["git", "init", "--quiet", "--initial-branch=master", path], None)
+    for idx in range(files):
+        _write(join(path, "src", "file{}.txt".format(idx)), "{}\n".format(idx))
+    _commit(path, "initial commit")
+
+    remote = join(remotes, name + ".git")
+    _run(["git", "clone", "--quiet", "--bare", path, remote], None)
+    _run(["git", "remote", "add", "origin", remote], path)
+    _run(["git", "fetch", "--quiet", "origin"], path)
+    _run(["git", "branch", "--quiet", "--set-upstream-to=origin/master"], path)
+
+    if kind == "changed":
+        _write(join(path, "src", "file0.txt"), "changed\n")
+    elif kind == "untracked":
+        _write(join(path, "new", "deeper", "untracked.txt"), "untracked\n")
+        _write(join(path, "untracked.txt"), "untracked\n")
+    elif kind == "stashed":
+        _write(join(path, "src", "file0.txt"), "stashed\n")
+        _run(["git", "stash", "--quiet"], path)
+    elif kind == "ahead":
+        _write(join(path, "ahead.txt"), "ahead\n")
+        _commit(path, "not pushed yet")
+    elif kind == "localbranch":
+        _run(["git", "checkout", "--quiet", "-b", "feature"], path)
+        _write(join(path, "feature.txt"), "feature\n")
+        _commit(path, "local-only branch")
+        _run(["git", "checkout", "--quiet", "master"], path)
+
+
+def makehgrepo(path, kind, files):
+    """Create an hg repo at *path* and leave it in *kind*"""
+    _run(["hg", "init", path], None)
+    for idx in range(files):
+        _write(join(path, "src", "file{}.txt".format(idx)), "{}\n".format(idx))
+    _run(["hg", "commit", "--addremove", "-u", "jerjerrod", "-m", "initial"], path)
+
+    if kind == "changed":
+        _write(join(path, "src", "file0.txt"), "changed\n")
+    elif kind == "untracked":
+        _write(join(path, "untracked.txt"), "untracked\n")
+
+
+def generate(dest, repos, files, hg=False):
+    """
+    Build a HOME at *dest* and return it. Anything already at *dest* is
+    removed first.
+    """
+    if hg and shutil.which("hg") is None:
+        raise Exception("--hg was requested but hg is not installed")
+
+    if os.path.exists(dest):
+        shutil.rmtree(dest)
+    home = os.path.abspath(dest)
+    workspace = join(home, "src", WORKSPACE)
+    remotes = join(home, "remotes")
+    os.makedirs(workspace)
+    os.makedirs(remotes)
+
+    for idx in range(repos):
+        kind = KINDS[idx % len(KINDS)]
+        makegitrepo(join(workspace, "git{:04d}".format(idx)), remotes, kind, files)
+        if hg:
+            makehgrepo(join(workspace, "hg{:04d}".format(idx)), kind, files)
+    # a folder which isn't a repo at all
+    os.makedirs(join(workspace, "garbage"))
+
+    makegitrepo(join(home, "src", SINGLE), remotes, "changed", files)
+
+    _write(
+        join(home, ".config", "jerjerrod", "jerjerrod.conf"),
+        "WORKSPACE ~/src/{}\nPROJECT ~/src/{} SPOTLIGHT\n".format(WORKSPACE, SINGLE),
+    )
+
+    # the powerline segments run `jerjerrod` to refresh the cache
+    bindir = join(home, "bin")
+    _write(
+        join(bindir, "jerjerrod"),
+        '#!/bin/sh\nexec "{}" -m jerjerrod.cli.entrypoint "$@"\n'.format(
+            sys.executable
+        ),
+    )
+    os.chmod(join(bindir, "jerjerrod"), 0o755)
+    return home
+
+
+def environ(home):
+    """Returns the environment variables for running jerjerrod in *home*"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    pythonpath = [root] + [p for p in [os.environ.get("PYTHONPATH")] if p]
+    return dict(
+        os.environ,
+        HOME=home,
+        XDG_CONFIG_HOME=join(home, ".config"),
+        XDG_CACHE_HOME=join(home, ".cache"),
+        # keep away from any jerjerrod daemon that the user is running
+        XDG_RUNTIME_DIR=join(home, ".run"),
+        PATH=os.pathsep.join([join(home, "bin"), os.environ.get("PATH", "")]),
+        PYTHONPATH=os.pathsep.join(pythonpath),
+    )
+
+
+@click.command()
+@click.argument("dest", type=click.Path(file_okay=False))
+@click.option("--repos", type=int, default=50, help="How many git repos to create")
+@click.option("--files", type=int, default=20, help="How many files each repo has")
+@click.option("--hg", is_flag=True, help="Also create as many hg repos")
+def main(dest, repos, files, hg):
+    home = generate(dest, repos, files, hg)
+    click.echo(home)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,58 +1,212 @@
-import base64
 import json
 import os
+import threading
 import time
+from collections import OrderedDict
 from datetime import date, datetime
 from os.path import exists, join
-from subprocess import check_call
+
+from xdg import xdg_cache_home
+
+from jerjerrod import tracing
 
 
 HOME = os.environ["HOME"]
-CACHEDIR = join(HOME, ".config", "jerjerrod", "cache")
+# all cached project info lives in a single sqlite database
+CACHEDB = str(xdg_cache_home() / "jerjerrod" / "jerjerrod.sqlite3")
 # re-check projects on the hour
 PROJECT_EXPIRY = 60 * 60
 # only check outgoing every 4 hours
 OUTGOING_EXPIRY = 60 * 60 * 4
 
 IGNORE_PATH = join(HOME, ".config", "jerjerrod", "ignore.json")
+# lock files saying which repos a `jerjerrod refresh` is working on
+REFRESH_LOCKDIR = str(xdg_cache_home() / "jerjerrod" / "refreshing")
+
+# how many kv values each DiskCache keeps in memory
+KV_MEMORY_ITEMS = 10000
+# sqlite limits how many ?-parameters a query may have
+_SQL_BATCH = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    key TEXT PRIMARY KEY,
+    stored REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    expires REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS kv_expires ON kv (expires);
+"""
+
+
+class _LRU(object):
+    """A dict which forgets its least recently used items beyond *maxsize*"""
+
+    def __init__(self, maxsize):
+        self._maxsize = maxsize
+        self._items = OrderedDict()
 
+    def get(self, key):
+        try:
+            self._items.move_to_end(key)
+        except KeyError:
+            return None
+        return self._items[key]
 
-def _getcachepath(path):
-    if ":" in path:
-        return base64.b64encode(path)
-    return path.replace("/", ":")
+    def set(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self._maxsize:
+            self._items.popitem(last=False)
 
 
 class DiskCache(object):
+    """
+    Stores project info in the sqlite database at CACHEDB.
+
+    Project records are stored with the time they were written, and the caller
+    decides at lookup time how old a record may be. The kv table holds other
+    values (such as git ancestry checks) which expire at a fixed time; recently
+    used kv values are also kept in memory.
+    """
+
+    _con = None
+    # records from loadall(), keyed by path
+    _loaded = None
+
+    def __init__(self, dbpath=CACHEDB):
+        self._dbpath = dbpath
+        # the same DiskCache is shared by all of a scan's worker threads
+        self._lock = threading.RLock()
+        # key => (expires, value)
+        self._kvmemo = _LRU(KV_MEMORY_ITEMS)
+
+    def _connect(self):
+        if self._con is None:
+            import sqlite3
+
+            os.makedirs(os.path.dirname(self._dbpath), exist_ok=True)
+            con = sqlite3.connect(self._dbpath, timeout=10, check_same_thread=False)
+            # WAL allows the powerline segment to read while a scan is writing
+            con.execute("PRAGMA journal_mode=WAL")
+            con.executescript(_SCHEMA)
+            self._con = con
+        return self._con
+
+    def loadall(self):
+        """
+        Read every project record into memory with a single query, so that
+        subsequent getcache() calls don't need to touch the database.
+        """
+        with self._lock, tracing.span("loadall", tracing.CACHE) as details:
+            rows = self._connect().execute("SELECT key, stored, data FROM records")
+            self._loaded = {key: (stored, data) for key, stored, data in rows}
+            if details is not None:
+                details["records"] = len(self._loaded)
+
+    def _getrecord(self, path):
+        if self._loaded is not None:
+            return self._loaded.get(path)
+        row = (
+            self._connect()
+            .execute("SELECT stored, data FROM records WHERE key = ?", (path,))
+            .fetchone()
+        )
+        return row
+
     def getcache(self, path, expiry):
-        sanepath = join(CACHEDIR, _getcachepath(path))
-
-        # convert path to something sane that doesn't include slashes
-        if not exists(sanepath):
-            return
-        if (os.stat(sanepath).st_mtime + expiry) < time.time():
-            os.unlink(sanepath)
-            return
-        with open(sanepath, "r") as f:
-            data = f.read()
-
-            # don't die horribly if the file is empty - empty files might
-            # happen when cache is written while the hdd is full
-            if len(data):
-                return json.loads(data)
+        with tracing.span("getcache", tracing.CACHE, repo=path) as details:
+            with self._lock:
+                record = self._getrecord(path)
+            hit = record is not None and (record[0] + expiry) >= time.time()
+            if details is not None:
+                details["hits" if hit else "misses"] = 1
+            if hit:
+                return json.loads(record[1])
 
     def setcache(self, path, info):
-        data = json.dumps(info)
-        if not exists(CACHEDIR):
-            check_call(["mkdir", "-p", CACHEDIR])
-        sanepath = join(CACHEDIR, _getcachepath(path))
-        with open(sanepath, "w") as f:
-            f.write(data)
+        record = (time.time(), json.dumps(info))
+        with tracing.span("setcache", tracing.CACHE, repo=path):
+            with self._lock, self._connect() as con:
+                con.execute(
+                    "INSERT OR REPLACE INTO records (key, stored, data)"
+                    " VALUES (?, ?, ?)",
+                    (path,) + record,
+                )
+                if self._loaded is not None:
+                    self._loaded[path] = record
+
+    def getstoredtime(self, path):
+        """Returns when the record for *path* was written, or None"""
+        with self._lock:
+            record = self._getrecord(path)
+        return None if record is None else record[0]
 
     def clearcache(self, path):
-        sanepath = join(CACHEDIR, _getcachepath(path))
-        if exists(sanepath):
-            os.unlink(sanepath)
+        with self._lock, self._connect() as con:
+            con.execute("DELETE FROM records WHERE key = ?", (path,))
+            if self._loaded is not None:
+                self._loaded.pop(path, None)
+
+    def getvalues(self, keys):
+        """
+        Returns a dict of the values stored at *keys* by setvalues(). Keys with
+        no value (or an expired one) are left out.
+        """
+        now = time.time()
+        found = {}
+        with self._lock, tracing.span("getvalues", tracing.CACHE) as details:
+            missing = []
+            for key in keys:
+                memo = self._kvmemo.get(key)
+                if memo is None:
+                    missing.append(key)
+                elif memo[0] >= now:
+                    found[key] = memo[1]
+
+            con = self._connect()
+            for start in range(0, len(missing), _SQL_BATCH):
+                batch = missing[start : start + _SQL_BATCH]
+                rows = con.execute(
+                    "SELECT key, expires, data FROM kv WHERE key IN (%s)"
+                    % ", ".join("?" * len(batch)),
+                    batch,
+                )
+                for key, expires, data in rows:
+                    value = json.loads(data)
+                    self._kvmemo.set(key, (expires, value))
+                    if expires >= now:
+                        found[key] = value
+            if details is not None:
+                details["hits"] = len(found)
+                details["misses"] = len(keys) - len(found)
+        return found
+
+    def setvalues(self, values, expire):
+        """Store each of the {key: value} pairs in *values* for *expire* seconds"""
+        now = time.time()
+        rows = [(key, now + expire, json.dumps(value)) for key, value in values.items()]
+        with tracing.span("setvalues", tracing.CACHE):
+            with self._lock, self._connect() as con:
+                con.execute("DELETE FROM kv WHERE expires < ?", (now,))
+                con.executemany(
+                    "INSERT OR REPLACE INTO kv (key, expires, data) VALUES (?, ?, ?)",
+                    rows,
+                )
+                for key, value in values.items():
+                    self._kvmemo.set(key, (now + expire, value))
+
+    def getvalue(self, key):
+        """Returns the value stored at *key* by setvalue(), or None"""
+        return self.getvalues([key]).get(key)
+
+    def setvalue(self, key, value, expire):
+        """Store *value* at *key* for the next *expire* seconds"""
+        self.setvalues({key: value}, expire)
 
     def getignorelist(self):
         if not exists(IGNORE_PATH):
@@ -72,3 +226,39 @@ class DiskCache(object):
         things = [str(name) for name in sequence]
         with open(IGNORE_PATH, "w") as f:
             json.dump(things, f)
+
+
+def lockrefresh(path):
+    """
+    Take the lock saying that the repo at *path* is being refreshed. Returns
+    an open file which holds the lock until it is closed or the process
+    exits, or None if another process is already refreshing the repo.
+    """
+    import fcntl
+    import hashlib
+
+    os.makedirs(REFRESH_LOCKDIR, exist_ok=True)
+    name = hashlib.sha1(path.encode()).hexdigest()
+    lockfile = open(join(REFRESH_LOCKDIR, name), "w")
+    try:
+        fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lockfile.close()
+        return None
+    return lockfile
+
+
+_SHARED = None
+_SHAREDLOCK = threading.Lock()
+
+
+def getsharedcache():
+    """
+    Returns a DiskCache shared by everything in this process, so that the
+    database is only opened once and the in-memory kv values are reused.
+    """
+    global _SHARED
+    with _SHAREDLOCK:
+        if _SHARED is None:
+            _SHARED = DiskCache()
+        return _SHARED
@@ -1,21 +1,56 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import json
 import sys
 from os import getcwd
-from os.path import basename, dirname, exists, join, realpath
+from os.path import dirname, exists, join, realpath
 
 import click
 
 from jerjerrod import __version__
-from jerjerrod.caching import DiskCache
+from jerjerrod import daemon, tracing
+from jerjerrod.caching import OUTGOING_EXPIRY, getsharedcache, lockrefresh
 from jerjerrod.cli.utils import RepoSummary, print_workspace_title, style
-from jerjerrod.projects import get_all_projects
+from jerjerrod.projects import (
+    INSPECT_BACKENDS,
+    INSPECT_JOBS,
+    ProjectIndex,
+    get_all_projects,
+    iter_inspected,
+    refresh_within,
+)
 
 
 @click.group(invoke_without_command=True)
 @click.pass_context
 @click.version_option(__version__, prog_name="jerjerrod")
-def cli(ctx):
+@click.option(
+    "--trace",
+    type=click.Path(dir_okay=False, writable=True),
+    help=(
+        "Record how long each repo, VCS command and cache lookup took in"
+        " TRACE, and print a summary of the slowest repos"
+    ),
+)
+@click.option(
+    "--trace-format",
+    type=click.Choice(tracing.TRACE_FORMATS),
+    default="jsonl",
+    show_default=True,
+    help="jsonl: one span per line. chrome: for chrome://tracing or Perfetto",
+)
+def cli(ctx, trace, trace_format):
+    if trace:
+        tracer = tracing.enable()
+
+        def dumptrace():
+            with open(trace, "w") as f:
+                tracer.dump(f, trace_format)
+            for line in tracer.summarise():
+                click.echo(line, err=True)
+
+        ctx.call_on_close(dumptrace)
+
     if ctx.invoked_subcommand is None:
         click.secho(
             "No subcommand specified. Clearing cache and presenting summary",
@@ -46,9 +81,87 @@ def cli(ctx):
 # WS outgoing NAME
 
 
+def inspect_options(func):
+    func = click.option(
+        "--backend",
+        type=click.Choice(sorted(INSPECT_BACKENDS)),
+        default="threads",
+        show_default=True,
+        help="How to run VCS commands when inspecting many repos",
+    )(func)
+    return click.option(
+        "-j",
+        "--jobs",
+        type=click.IntRange(min=1),
+        default=INSPECT_JOBS,
+        show_default=True,
+        help=(
+            "Maximum number of repos to inspect at the same time"
+            " (asyncio backend: maximum number of VCS commands)"
+        ),
+    )(func)
+
+
+def no_daemon_option(func):
+    return click.option(
+        "--no-daemon",
+        is_flag=True,
+        help="Inspect projects directly even if `jerjerrod daemon` is running",
+    )(func)
+
+
+def stale_option(func):
+    return click.option(
+        "--stale",
+        is_flag=True,
+        help=(
+            "Answer straight away from cached info even if it has expired, and"
+            " refresh expired repos in the background"
+        ),
+    )(func)
+
+
+def refresh_in_background(paths):
+    """Start a detached `jerjerrod refresh` of *paths* without waiting for it"""
+    import subprocess
+
+    cmd = [sys.executable, "-m", "jerjerrod.cli.entrypoint", "refresh", "--"]
+    subprocess.Popen(
+        cmd + list(paths),
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def _stalepaths(projects):
+    return [
+        repo.project_path
+        for proj in projects
+        for repo in proj.getrepos()
+        if repo.isstale()
+    ]
+
+
 @cli.command()
 @click.argument("STATUS", nargs=-1)
-def namesbystatus(status):
+@inspect_options
+@no_daemon_option
+@stale_option
+@click.option(
+    "--format",
+    "format_",
+    type=click.Choice(["names", "jsonl"]),
+    default="names",
+    show_default=True,
+    help=(
+        "jsonl: print a JSON object with the status, branch and counts of each"
+        " project as soon as it has been inspected, slowest last. Doesn't use"
+        " the daemon."
+    ),
+)
+def namesbystatus(status, jobs, backend, no_daemon, stale, format_):
     """
     Names returned will be one of the following:
     - names of workspaces that match the given STATUS
@@ -63,45 +176,131 @@ def namesbystatus(status):
     """
     assert len(status)
     assert isinstance(status, tuple)
+
+    if format_ == "jsonl":
+        _streamsummaries(status, jobs, backend, stale)
+        return
+
+    names = None if no_daemon else daemon.query("namesbystatus", statuses=status)
+    if names is not None:
+        for name in names:
+            print(name)
+        return
+
     # use the disk cache
-    for proj in get_all_projects(DiskCache(), {}):
+    cache = getsharedcache()
+    cache.loadall()
+
+    if stale:
+        projects = list(get_all_projects(cache, {}))
+        for proj in projects:
+            if proj.getstatus(False) in status:
+                print(proj.getname())
+        stalepaths = _stalepaths(projects)
+        if stalepaths:
+            click.echo(
+                "jerjerrod: {} repos are stale and being refreshed".format(
+                    len(stalepaths)
+                ),
+                err=True,
+            )
+            refresh_in_background(stalepaths)
+        return
+
+    for proj in iter_inspected(get_all_projects(cache, {}), jobs, backend):
         if proj.getstatus(True) in status:
             print(proj.getname())
 
 
+def _streamsummaries(status, jobs, backend, stale):
+    cache = getsharedcache()
+    cache.loadall()
+
+    projects = get_all_projects(cache, {})
+    if stale:
+        projects = list(projects)
+    else:
+        projects = iter_inspected(projects, jobs, backend, ordered=False)
+    for proj in projects:
+        summary = proj.getsummary(not stale)
+        if summary["status"] in status:
+            click.echo(json.dumps(summary))
+    if stale:
+        stalepaths = _stalepaths(projects)
+        if stalepaths:
+            refresh_in_background(stalepaths)
+
+
 @cli.command()
 @click.argument("NAME_OR_PATH")
-def summary(name_or_path):
-    present_summary(name_or_path)
-
+@inspect_options
+@no_daemon_option
+@stale_option
+@click.option(
+    "--full",
+    is_flag=True,
+    help="List every changed and untracked file (always inspects the repos)",
+)
+def summary(name_or_path, jobs, backend, no_daemon, stale, full):
+    present_summary(name_or_path, jobs, backend, no_daemon, stale, full)
+
+
+def present_summary(
+    name_or_path,
+    jobs=INSPECT_JOBS,
+    backend="threads",
+    no_daemon=False,
+    stale=False,
+    full=False,
+):
+    # cached records only hold a sample of the changed and untracked files
+    if not no_daemon and not full:
+        # the daemon would resolve relative paths against its own cwd
+        if exists(name_or_path):
+            name_or_path = realpath(name_or_path)
+        record = daemon.query("summary", name_or_path=name_or_path)
+        if record is not None:
+            print_record(record)
+            return
 
-def present_summary(name_or_path):
     # use the disk cache
-    cache = DiskCache()
-
-    match1 = None
-    match2 = None
-    for proj in get_all_projects(cache, {}):
-        if proj.getname() == basename(name_or_path):
-            match1 = proj
-            break
-        if proj.containspath(name_or_path):
-            if not match2:
-                match2 = proj
+    cache = getsharedcache()
+    cache.loadall()
 
-    project = match1 or match2
+    project = ProjectIndex(get_all_projects(cache, {})).find(name_or_path)
 
     if not project:
         raise Exception("No project {}".format(name_or_path))
 
-    if hasattr(project, "_repos"):
-        print_workspace_title(project)
+    if stale and not full:
+        print_record(project.getrecord(False))
+        stalepaths = _stalepaths([project])
+        if stalepaths:
+            refresh_in_background(stalepaths)
+        return
+
+    if full:
+        # getfullrecord() inspects each repo once with the full lists, so
+        # inspecting them up front would run `git status` twice
+        print_record(project.getfullrecord(), full=True)
+        return
+
+    # inspect all of the project's repos up front so they can run in parallel
+    for _ in iter_inspected([project], jobs, backend):
+        pass
+
+    print_record(project.getrecord(True))
+
+
+def print_record(record, full=False):
+    if record["isworkspace"]:
+        print_workspace_title(record["path"])
         # TODO: summarise workspace
         indent = 2
-        for repo in project._repos:
-            rs = RepoSummary(repo, indent)
+        for repo in record["repos"]:
+            rs = RepoSummary(repo, indent, full)
             rs.printnow()
-        garbage = project.getgarbage()
+        garbage = record["garbage"]
         if len(garbage) == 1:
             click.echo(
                 style("s_untracked", "%sGARBAGE: %s" % (" " * indent, garbage[0]))
@@ -111,24 +310,148 @@ def present_summary(name_or_path):
             for g in garbage:
                 click.echo(style("s_untracked", "%s  %s" % (" " * indent, g)))
     else:
-        rs = RepoSummary(project, 0)
+        rs = RepoSummary(record, 0, full)
         rs.printnow()
 
 
+@cli.command()
+@click.argument("NAME_OR_PATH", nargs=-1)
+@click.option("--all", "all_", is_flag=True, help="Export every project")
+@inspect_options
+@stale_option
+@click.option(
+    "--format",
+    "format_",
+    type=click.Choice(["json", "marshal"]),
+    default="json",
+    show_default=True,
+    help="marshal: Python's marshal format, which is quicker to load",
+)
+def status(name_or_path, all_, jobs, backend, stale, format_):
+    """
+    Write the records of the projects at NAME_OR_PATH, or of every project with
+    --all, as a single document: each workspace lists its repos and garbage.
+    """
+    if not (all_ or name_or_path):
+        raise click.UsageError("Give NAME_OR_PATH or --all")
+
+    # use the disk cache
+    cache = getsharedcache()
+    cache.loadall()
+    ignored = cache.getignorelist()
+
+    if all_:
+        projects = list(get_all_projects(cache, {}))
+    else:
+        index = ProjectIndex(get_all_projects(cache, {}))
+        projects = []
+        for name in name_or_path:
+            project = index.find(name)
+            if not project:
+                raise Exception("No project {}".format(name))
+            projects.append(project)
+
+    if stale:
+        stalepaths = _stalepaths(projects)
+        if stalepaths:
+            refresh_in_background(stalepaths)
+    else:
+        for _ in iter_inspected(projects, jobs, backend):
+            pass
+
+    records = []
+    for project in projects:
+        record = project.getrecord(not stale)
+        record["ignored"] = project.project_path in ignored
+        records.append(record)
+    document = {"version": __version__, "projects": records}
+
+    if format_ == "marshal":
+        import marshal
+
+        sys.stdout.buffer.write(marshal.dumps(document))
+    else:
+        click.echo(json.dumps(document))
+
+
+@cli.command()
+@click.argument("PATH", nargs=-1)
+@inspect_options
+@click.option(
+    "--remote",
+    is_flag=True,
+    help=(
+        "Also ask the remotes of hg repos what is outgoing, instead of only"
+        " counting unpublished changesets. Only `jerjerrod daemon --remote`"
+        " does this by itself, so otherwise run `jerjerrod refresh --remote` by"
+        " hand or on a schedule (e.g. from cron)."
+    ),
+)
+@click.option(
+    "--budget",
+    type=float,
+    metavar="SECONDS",
+    help=(
+        "Only spend about this long, on the stale repos which most need it:"
+        " the one containing the current folder, SPOTLIGHT repos, and then the"
+        " ones which are quickest to refresh for how long ago they were"
+        " inspected"
+    ),
+)
+def refresh(path, jobs, backend, remote, budget):
+    """
+    Inspect the repos at PATH, or every repo, and update the cache. Used by
+    --stale to refresh expired repos in the background.
+    """
+    cache = getsharedcache()
+    cache.loadall()
+
+    # configured paths may go through symlinks, so compare real paths
+    wanted = set(map(realpath, path))
+    repos = [
+        repo
+        for proj in get_all_projects(cache, {})
+        for repo in proj.getrepos()
+        if not wanted or realpath(repo.project_path) in wanted
+    ]
+    if wanted:
+        # every --stale answer starts a refresh of the stale repos it saw, so
+        # leave out the repos which an earlier refresh is still working on
+        locks = {repo: lockrefresh(realpath(repo.project_path)) for repo in repos}
+        repos = [repo for repo, lock in locks.items() if lock is not None]
+    if budget is not None:
+        refresh_within(repos, budget, cache, jobs, backend, getcwd())
+    else:
+        for _ in iter_inspected(repos, jobs, backend):
+            pass
+
+    if remote:
+        from concurrent.futures import ThreadPoolExecutor
+
+        def refreshremote(repo):
+            try:
+                repo.refreshremote()
+            except Exception as err:
+                click.echo("{}: {}".format(repo.project_path, err), err=True)
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            list(pool.map(refreshremote, repos))
+
+
 @cli.command()
 @click.argument("NAMES_AND_PATHS", nargs=-1)
 def nottoday(names_and_paths):
     """Tell jerjerrod not to report about certain projects until tomorrow."""
     # use the disk cache
-    cache = DiskCache()
+    cache = getsharedcache()
 
     # grab the current ignore list
     ignore = cache.getignorelist()
 
-    for proj in get_all_projects(cache, {}):
-        for name_or_path in names_and_paths:
-            if proj.getname() == name_or_path or proj.containspath(name_or_path):
-                ignore.add(proj.project_path)
+    index = ProjectIndex(get_all_projects(cache, {}))
+    for name_or_path in names_and_paths:
+        for proj in index.findall(name_or_path):
+            ignore.add(proj.project_path)
 
     # save the new ignore list
     cache.setignorelist(ignore)
@@ -145,7 +468,7 @@ def clearcache(path, local):
 
 
 def do_clearcache(path, local):
-    cache = DiskCache()
+    cache = getsharedcache()
 
     def _checkandclear(path):
         if exists(join(path, ".git")) or exists(join(path, ".hg")):
@@ -159,6 +482,49 @@ def do_clearcache(path, local):
             # shorten the path and try again
             trypath = dirname(trypath)
 
+    # make sure a running daemon doesn't hold on to what we just cleared
+    daemon.query("refresh", timeout=60)
+
+
+@cli.command("daemon")
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=INSPECT_JOBS,
+    show_default=True,
+    help="Maximum number of repos to inspect at the same time",
+)
+@click.option(
+    "--interval",
+    type=click.IntRange(min=1),
+    help=(
+        "Seconds between background refreshes"
+        " [default: {}, or {} with --watch]".format(
+            daemon.REFRESH_INTERVAL, daemon.WATCH_REFRESH_INTERVAL
+        )
+    ),
+)
+@click.option(
+    "--watch",
+    is_flag=True,
+    help="Use inotify to re-inspect repos as soon as they change (Linux only)",
+)
+@click.option(
+    "--remote",
+    is_flag=True,
+    help=(
+        "Also ask the remotes of hg repos what is outgoing, every {} hours,"
+        " like `jerjerrod refresh --remote`".format(OUTGOING_EXPIRY // 3600)
+    ),
+)
+def daemon_(jobs, interval, watch, remote):
+    """
+    Keep project status in memory and answer queries from other jerjerrod
+    commands and the powerline segments over a unix socket.
+    """
+    daemon.serve(jobs, interval, watch, remote)
+
 
 if __name__ == "__main__":
     cli()
@@ -17,16 +17,20 @@ def _shortpath(pathstr):
     return pathstr
 
 
-def print_workspace_title(project):
-    click.secho(":: %s ++" % _shortpath(project._path), fg="blue", bold=True)
+def print_workspace_title(path: str) -> None:
+    click.secho(":: %s ++" % _shortpath(path), fg="blue", bold=True)
     # sys.stdout.write(style_wspath(_shortpath(project._path)))
     # sys.stdout.write(style_wstitle("] ::") + "\n")
 
 
-def _getfilesstr(files: List[str]) -> str:
-    if len(files) == 0:
+def _getfilesstr(files: List[str], count: int) -> str:
+    if count == 0:
         return ""
 
+    # *files* is only a sample of the names when there are many
+    if count > len(files):
+        return str(count)
+
     # can we fit the names of all the things changed into one 40-character
     # string?
     joined = ", ".join(files)
@@ -59,33 +63,58 @@ def style(stylename: "Optional[str]", text: str) -> str:
 class RepoSummary:
     _main_style: "Optional[StyleName]" = None
 
-    def __init__(self, repo, indent: int) -> None:
-        self._repo = repo
+    def __init__(self, record, indent: int, full: bool = False) -> None:
+        """
+        *record* is a dict from Repo.getrecord(), or Repo.getfullrecord() when
+        *full* is True, in which case every file is listed.
+        """
+        self._path: str = record["path"]
         self._indent: str = " " * indent
-
-        info = repo._getinfo(True)
+        self._full = full
+        # records from older versions don't say whether they're stale
+        self._marker: str = " (stale)" if record.get("stale") else ""
+
+        info = record["info"]
+        if info is None:
+            if record.get("error"):
+                self._marker = " (inspecting failed: {})".format(record["error"])
+            else:
+                self._marker = " (not inspected yet)"
+            info = {
+                "branch": None,
+                "changed": [],
+                "nchanged": 0,
+                "untracked": [],
+                "nuntracked": 0,
+                "outgoing": 0,
+                "stashes": 0,
+            }
 
         self._branch: str = info["branch"]
         self._files_changed = info["changed"]
         self._files_untracked = info["untracked"]
+        # older records have complete lists instead of counts
+        self._num_changed: int = info.get("nchanged", len(self._files_changed))
+        self._num_untracked: int = info.get("nuntracked", len(self._files_untracked))
         # when inspecting HG repos, outgoing might be a string
         self._outgoing_info = "" if info["outgoing"] == 0 else info["outgoing"]
         self._num_stashes: int = info["stashes"]
 
-        if len(self._files_changed):
+        if self._num_changed:
             self._main_style = "s_changed"
         elif self._outgoing_info:
             self._main_style = "s_unpushed"
-        elif len(self._files_untracked) or self._num_stashes:
+        elif self._num_untracked or self._num_stashes:
             self._main_style = "s_untracked"
 
     def _printtitle(self):
-        click.echo(
-            style(
-                self._main_style,
-                "%s> %s" % (self._indent, _shortpath(self._repo._path)),
-            )
+        title = style(
+            self._main_style,
+            "%s> %s" % (self._indent, _shortpath(self._path)),
         )
+        if self._marker:
+            title += click.style(self._marker, fg="black", dim=True)
+        click.echo(title)
 
     def printnow(self):
         self._printtitle()
@@ -93,14 +122,14 @@ class RepoSummary:
         # make a collection of stats to print (if needed)
         stats: List[str] = []
 
-        changes = _getfilesstr(self._files_changed)
+        changes = _getfilesstr(self._files_changed, self._num_changed)
         if changes:
             stats.append(style("s_changed", "Changed: " + changes))
 
         if self._outgoing_info:
             stats.append(style("s_unpushed", "Outgoing: %s" % (self._outgoing_info,)))
 
-        untracked = _getfilesstr(self._files_untracked)
+        untracked = _getfilesstr(self._files_untracked, self._num_untracked)
         if untracked:
             stats.append(style("s_untracked", "Untracked: " + untracked))
 
@@ -115,3 +144,9 @@ class RepoSummary:
             else:
                 for stat in stats:
                     click.echo("%s  %s" % (self._indent, stat))
+
+        if self._full:
+            for name in self._files_changed:
+                click.echo(style("s_changed", "%s    M %s" % (self._indent, name)))
+            for name in self._files_untracked:
+                click.echo(style("s_untracked", "%s    ? %s" % (self._indent, name)))
@@ -1,24 +1,114 @@
 import glob
+import json
 import os.path
 import re
 from os.path import join
 
-import diskcache
-from xdg import xdg_config_home, xdg_cache_home
+from xdg import xdg_cache_home, xdg_config_home
 
 RCFILE = str(xdg_config_home() / "jerjerrod" / "jerjerrod.conf")
+# the parsed RCFILE with all of its globs expanded
+COMPILEDFILE = str(xdg_cache_home() / "jerjerrod" / "config.json")
+
+# values for the UNTRACKED= flag, for git repos which are slow to inspect:
+#   all    - list every untracked file (the default)
+#   cached - the same, but let git use its untracked cache and fsmonitor
+#   normal - like cached, but list untracked folders without looking inside
+#   no     - don't look for untracked files at all
+UNTRACKED_MODES = ("all", "cached", "normal", "no")
+
+# the $VAR and ${VAR} references which os.path.expandvars() expands
+_ENVVAR = re.compile(r"\$(\w+|\{[^}]*\})")
+
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _loadcompiled(cache, rcstamp):
+    """
+    Fill *cache* from COMPILEDFILE, as long as it was compiled from the current
+    RCFILE with the same environment variables, and none of the folders its
+    globs listed have changed since.
+    """
+    try:
+        with open(COMPILEDFILE) as f:
+            compiled = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    if compiled.get("RCFILE") != rcstamp:
+        return False
+    env = compiled.get("ENV")
+    if env is None or any(os.environ.get(k) != v for k, v in env.items()):
+        return False
+    for path, stamp in compiled["GLOBDIRS"].items():
+        if _stamp(path) != stamp:
+            return False
+
+    cache["WORKSPACES"] = compiled["WORKSPACES"]
+    cache["SINGLES"] = compiled["SINGLES"]
+    return True
+
+
+def _savecompiled(cache, rcstamp):
+    compiled = {
+        "RCFILE": rcstamp,
+        "ENV": {name: os.environ.get(name) for name in cache["ENVVARS"]},
+        "GLOBDIRS": {path: _stamp(path) for path in cache["GLOBDIRS"]},
+        "WORKSPACES": cache["WORKSPACES"],
+        "SINGLES": cache["SINGLES"],
+    }
+    os.makedirs(os.path.dirname(COMPILEDFILE), exist_ok=True)
+    # write to a temporary file first so other processes never see a partial file
+    tmppath = "{}.{}".format(COMPILEDFILE, os.getpid())
+    with open(tmppath, "w") as f:
+        json.dump(compiled, f)
+    os.replace(tmppath, COMPILEDFILE)
+
+
+def _globdirs(pattern):
+    """Returns the folders which glob.glob(pattern) needs to look inside"""
+    parts = pattern.split(os.sep)
+    magic = [idx for idx, part in enumerate(parts) if glob.has_magic(part)]
+    if not magic:
+        return [os.path.dirname(pattern)]
+
+    dirs = []
+    for idx in range(magic[0], len(parts)):
+        parent = os.sep.join(parts[:idx]) or os.sep
+        if glob.has_magic(parent):
+            dirs.extend(glob.glob(parent))
+        else:
+            # keep it even if it doesn't exist yet, so creating it later
+            # changes its stamp
+            dirs.append(parent)
+    return dirs
 
 
 def _populateconfig(cache):
     if "WORKSPACES" in cache:
         return
 
-    cache["WORKSPACES"] = {}
-    cache["SINGLES"] = []
+    rcstamp = _stamp(RCFILE)
+    if rcstamp is None:
+        cache["WORKSPACES"] = {}
+        cache["SINGLES"] = []
+        return
 
-    if not os.path.exists(RCFILE):
+    if _loadcompiled(cache, rcstamp):
         return
 
+    cache["WORKSPACES"] = {}
+    cache["SINGLES"] = []
+    cache["GLOBDIRS"] = set()
+    # expanduser() reads $HOME
+    cache["ENVVARS"] = {"HOME"}
+
     with open(RCFILE, "r") as f:
         number = 0
         for line in f:
@@ -27,6 +117,8 @@ def _populateconfig(cache):
             if len(stripped):
                 _readcfgline(number, stripped, cache)
 
+    _savecompiled(cache, rcstamp)
+
 
 def _readcfgline(number, line, cache):
     if line.startswith("#"):
@@ -41,6 +133,8 @@ def _readcfgline(number, line, cache):
     if path.startswith('"'):
         path = path[1:-1]
 
+    for name in _ENVVAR.findall(path):
+        cache["ENVVARS"].add(name.strip("{}"))
     path = os.path.expandvars(path)
     path = os.path.expanduser(path)
 
@@ -49,15 +143,19 @@ def _readcfgline(number, line, cache):
             continue
         if flag == "SPOTLIGHT":
             continue
+        if flag.startswith("UNTRACKED=") and flag[10:] in UNTRACKED_MODES:
+            continue
         raise Exception("Invalid CFG flag on line %d: %r" % (number, flag))
+    if keyword in ("WORKSPACE", "PROJECT"):
+        cache["GLOBDIRS"].update(_globdirs(path))
     if keyword == "WORKSPACE":
         for match in glob.glob(path):
             name = os.path.basename(match)
-            cache["WORKSPACES"][name] = (match, flags)
+            cache["WORKSPACES"][name] = [match, flags]
         return
     if keyword == "PROJECT":
         for match in glob.glob(path):
-            cache["SINGLES"].append((os.path.basename(match), match, flags))
+            cache["SINGLES"].append([os.path.basename(match), match, flags])
         return
     if keyword == "FORGET":
         for thing in list(cache["SINGLES"]):
@@ -85,9 +183,3 @@ def get_workspaces(cache):
 def get_singles(cache):
     _populateconfig(cache)
     return cache["SINGLES"]
-
-
-def get_improved_cache() -> diskcache.Cache:
-    cache_path = xdg_cache_home() / "jerjerrod"
-    cache = diskcache.Cache(cache_path)
-    return cache
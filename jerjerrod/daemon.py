@@ -0,0 +1,202 @@
+"""
+`jerjerrod daemon` keeps the status of every project in memory, refreshes it
+in the background, and answers queries from the CLI and powerline segments
+over a unix socket.
+
+The protocol is a single line of JSON in each direction. A request looks like
+{"cmd": "wsnames", "category": "JERJERROD:CHANGED"} and the response is either
+{"result": ...} or {"error": "..."}.
+
+NOTE: this module is imported by the powerline segments, so the client half
+must not import anything expensive.
+"""
+
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+from xdg import xdg_cache_home, xdg_runtime_dir
+
+SOCKET_PATH = str(
+    (xdg_runtime_dir() or (xdg_cache_home() / "jerjerrod")) / "jerjerrod.sock"
+)
+
+# how long clients wait for the daemon to answer before giving up on it
+QUERY_TIMEOUT = 1.0
+# how often the daemon re-scans all projects
+REFRESH_INTERVAL = 30
+# with --watch, full rescans are only a safety net
+WATCH_REFRESH_INTERVAL = 60 * 10
+
+
+def query(cmd, timeout=QUERY_TIMEOUT, **args):
+    """
+    Send a query to the daemon and return its result, or None if the daemon
+    isn't running or didn't answer in time.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(SOCKET_PATH)
+        sock.sendall(json.dumps(dict(args, cmd=cmd)).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as f:
+            response = json.loads(f.readline())
+    except (OSError, ValueError):
+        return None
+    finally:
+        sock.close()
+
+    if "error" in response:
+        raise Exception("jerjerrod daemon: {}".format(response["error"]))
+    return response["result"]
+
+
+class Daemon(object):
+    _watcher = None
+
+    def __init__(self, jobs, interval):
+        from jerjerrod.scanner import Scanner
+
+        self._scanner = Scanner(jobs=jobs)
+        self._interval = interval
+        self._wakeup = threading.Event()
+
+    def startwatching(self):
+        from jerjerrod.watcher import Watcher
+
+        self._watcher = Watcher(self.reinspect)
+        self._watcher.start()
+
+    def refresh(self):
+        self._scanner.refresh()
+        if self._watcher is not None:
+            self._watcher.setrepos(
+                {
+                    repo.project_path: repo.getmetadirs()
+                    for repo in self._scanner.getrepos()
+                }
+            )
+
+    def reinspect(self, path):
+        """Re-inspect the repo at *path* after the watcher has seen it change"""
+        self._scanner.refresh([path])
+
+    def saferefresh(self):
+        """refresh(), but print the error instead of giving up on failure"""
+        try:
+            self.refresh()
+        except Exception:
+            traceback.print_exc()
+
+    def refreshloop(self):
+        while True:
+            self._wakeup.wait(self._interval)
+            self._wakeup.clear()
+            self.saferefresh()
+
+    def remoteloop(self):
+        """Ask the remotes of hg repos what is outgoing every OUTGOING_EXPIRY"""
+        from jerjerrod.caching import OUTGOING_EXPIRY
+
+        while True:
+            try:
+                self._scanner.refreshremote()
+            except Exception:
+                traceback.print_exc()
+            time.sleep(OUTGOING_EXPIRY)
+
+    def answer(self, request):
+        from jerjerrod.caching import getsharedcache
+
+        cmd = request["cmd"]
+        records = self._scanner.snapshot()
+
+        if cmd == "ping":
+            return True
+
+        if cmd == "refresh":
+            self.refresh()
+            return True
+
+        if cmd == "wsnames":
+            ignored = getsharedcache().getignorelist()
+            return [
+                record["name"]
+                for record in records.values()
+                if record["status"] == request["category"]
+                and record["path"] not in ignored
+            ]
+
+        if cmd == "snapshot":
+            ignored = getsharedcache().getignorelist()
+            snapshot = {}
+            for record in records.values():
+                if record["path"] not in ignored:
+                    snapshot.setdefault(record["status"], []).append(record["name"])
+            return snapshot
+
+        if cmd == "namesbystatus":
+            return [
+                record["name"]
+                for record in records.values()
+                if record["status"] in request["statuses"]
+            ]
+
+        if cmd == "summary":
+            # None (rather than an error) lets the client look for the
+            # project itself, e.g. one added to the config since the last
+            # refresh
+            return self._scanner.find(request["name_or_path"])
+
+        raise Exception("Unknown command {!r}".format(cmd))
+
+
+def serve(jobs, interval=None, watch=False, remote=False):
+    import signal
+    import socketserver
+
+    class _Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                request = json.loads(self.rfile.readline())
+                response = {"result": self.server.jerjerrod.answer(request)}
+            except Exception as err:
+                response = {"error": str(err)}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+    if query("ping") is not None:
+        raise Exception("jerjerrod daemon is already running")
+
+    if interval is None:
+        interval = WATCH_REFRESH_INTERVAL if watch else REFRESH_INTERVAL
+
+    daemon = Daemon(jobs, interval)
+    if watch:
+        daemon.startwatching()
+    # a failed refresh is retried by refreshloop()
+    daemon.saferefresh()
+    threading.Thread(target=daemon.refreshloop, daemon=True).start()
+    if remote:
+        threading.Thread(target=daemon.remoteloop, daemon=True).start()
+
+    # clean up after a daemon that didn't exit cleanly
+    if os.path.exists(SOCKET_PATH):
+        os.unlink(SOCKET_PATH)
+    os.makedirs(os.path.dirname(SOCKET_PATH), exist_ok=True)
+
+    server = socketserver.ThreadingUnixStreamServer(SOCKET_PATH, _Handler)
+    server.jerjerrod = daemon
+    server.daemon_threads = True
+    os.chmod(SOCKET_PATH, 0o600)
+
+    # make sure the socket is removed when we're killed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(SOCKET_PATH)
@@ -0,0 +1,188 @@
+"""
+A pool of long-lived Mercurial command servers (`hg serve --cmdserver pipe`),
+so that inspecting hg repos doesn't pay for starting hg for every command.
+
+A command server isn't tied to the folder it was started in; every command is
+run with `--cwd REPO`, so any idle server can be used for any repo. Servers
+which have been idle for IDLE_TIMEOUT seconds are shut down.
+
+See https://www.mercurial-scm.org/wiki/CommandServer for the protocol.
+"""
+
+import atexit
+import os
+import select
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from subprocess import PIPE, STDOUT, CalledProcessError, Popen, TimeoutExpired
+
+# how many command servers may be running at the same time
+POOL_SIZE = 8
+# shut down command servers which haven't been used for this many seconds
+IDLE_TIMEOUT = 60
+
+_HEADER = struct.Struct(">cI")
+_INT = struct.Struct(">i")
+
+
+class CommandServer(object):
+    """A single `hg serve --cmdserver pipe` process"""
+
+    def __init__(self):
+        self._proc = Popen(
+            ["hg", "serve", "--cmdserver", "pipe", "--config", "ui.interactive=no"],
+            stdin=PIPE,
+            stdout=PIPE,
+            cwd="/",
+            # make sure the user's aliases and settings can't change the output
+            env=dict(os.environ, HGPLAIN="1"),
+        )
+        channel, hello = self._readchannel(None)
+        if channel != b"o" or b"runcommand" not in hello.split(b"\n", 1)[0]:
+            self.close()
+            raise Exception("hg command server doesn't support runcommand")
+
+    def _read(self, size, deadline):
+        fd = self._proc.stdout.fileno()
+        chunks = []
+        while size:
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                    raise TimeoutError()
+            chunk = os.read(fd, size)
+            if not chunk:
+                raise Exception("hg command server exited unexpectedly")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def _readchannel(self, deadline):
+        channel, length = _HEADER.unpack(self._read(_HEADER.size, deadline))
+        if channel in b"IL":
+            # hg wants input; *length* is how much it wants, not a payload
+            return channel, length
+        return channel, self._read(length, deadline)
+
+    def runcommand(self, args, mergeerr=False, timeout=None):
+        """
+        Run `hg ARGS` and return its exit code, its output and its error
+        output. With *mergeerr*, the error output is included in the output
+        instead.
+
+        Raises TimeoutError if the command took longer than *timeout* seconds,
+        after which this server can't be used any more.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        data = "\0".join(args).encode("utf-8")
+        self._proc.stdin.write(b"runcommand\n" + _INT.pack(len(data)) + data)
+        self._proc.stdin.flush()
+
+        output = []
+        errors = output if mergeerr else []
+        while True:
+            channel, payload = self._readchannel(deadline)
+            if channel == b"o":
+                output.append(payload)
+            elif channel == b"e":
+                errors.append(payload)
+            elif channel == b"r":
+                code = _INT.unpack(payload)[0]
+                return code, b"".join(output), b"".join(errors)
+            elif channel in b"IL":
+                # ui.interactive is off, so just tell hg there is no input
+                self._proc.stdin.write(_INT.pack(0))
+                self._proc.stdin.flush()
+            elif channel.isupper():
+                raise Exception("Unexpected hg command server channel %r" % channel)
+
+    def close(self):
+        try:
+            self._proc.stdin.close()
+            self._proc.wait(timeout=5)
+        except (OSError, TimeoutExpired):
+            self.kill()
+
+    def kill(self):
+        self._proc.kill()
+        self._proc.wait()
+
+
+class ServerPool(object):
+    def __init__(self, size=POOL_SIZE, idletimeout=IDLE_TIMEOUT):
+        self._idletimeout = idletimeout
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        # [(time last used, server)], most recently used last
+        self._idle = []
+        self._reaper = None
+
+    @contextmanager
+    def _server(self):
+        with self._slots:
+            with self._lock:
+                server = self._idle.pop()[1] if self._idle else None
+            if server is None:
+                server = CommandServer()
+                self._startreaper()
+            try:
+                yield server
+            except BaseException:
+                # the server may be halfway through a command
+                server.kill()
+                raise
+            with self._lock:
+                self._idle.append((time.monotonic(), server))
+
+    def _startreaper(self):
+        with self._lock:
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._reaploop, daemon=True)
+                self._reaper.start()
+
+    def _reaploop(self):
+        while True:
+            time.sleep(self._idletimeout / 2)
+            self.reap(self._idletimeout)
+
+    def reap(self, idletime=0):
+        """Shut down servers which have been idle for at least *idletime*"""
+        cutoff = time.monotonic() - idletime
+        with self._lock:
+            expired = [server for when, server in self._idle if when <= cutoff]
+            self._idle = [(when, s) for when, s in self._idle if when > cutoff]
+        for server in expired:
+            server.close()
+
+    def check_output(self, args, cwd, stderr=None, timeout=None):
+        """
+        Equivalent of subprocess.check_output(["hg"] + args, cwd=cwd, ...)
+        which uses one of the pool's command servers. *stderr* may be STDOUT;
+        otherwise hg's error output is discarded.
+        """
+        try:
+            with self._server() as server:
+                code, output, _ = server.runcommand(
+                    ["--cwd", cwd] + list(args), stderr == STDOUT, timeout
+                )
+        except TimeoutError:
+            raise TimeoutExpired(["hg"] + list(args), timeout)
+        if code:
+            raise CalledProcessError(code, ["hg"] + list(args), output=output)
+        return output
+
+
+_POOL = None
+_POOLLOCK = threading.Lock()
+
+
+def getpool():
+    """Returns the ServerPool shared by everything in this process"""
+    global _POOL
+    with _POOLLOCK:
+        if _POOL is None:
+            _POOL = ServerPool()
+            atexit.register(_POOL.reap)
+        return _POOL
@@ -1,52 +1,168 @@
 from __future__ import absolute_import, division, unicode_literals, print_function
+import logging
 import os
+import threading
 import time
-import subprocess
+import traceback
 
+from jerjerrod import daemon
 from jerjerrod.config import RCFILE
-from jerjerrod.caching import DiskCache
-from jerjerrod.projects import get_all_projects
+from jerjerrod.caching import getsharedcache
+from jerjerrod.projects import REFRESH_BUDGET
 
 
-# expire project list after 1 second
-_SUB = None
-_SUBTIME = None
-_SUBEXPIRE = 60 * 60
+# how often the background refresher looks for stale repos
+_REFRESH_INTERVAL = 60
+# while there are still stale repos, the next refresh starts after this long
+_CONTINUE_INTERVAL = 1
+# after a refresh fails, wait this long before trying again, doubling each
+# time it fails again
+_BACKOFF = 30
+_MAXBACKOFF = 60 * 30
 
-# we want a cache for the config stuff
-_CFGCACHE = {}
-_CFGTIME = None
-
-
-def _refresh(force):
-    global _SUB, _SUBTIME
-    if _SUB:
-        # TODO: garbage-collect the thing if it's finished
-        retval = _SUB.poll()
-        if retval is not None:
-            _SUB = None if retval == 0 else False
-            _SUBTIME = time.time()
-        return
-
-    if _SUB is False:
-        return
-
-    # if its expired, start a new one
-    if _SUBTIME is not None and (time.time() - _SUBTIME) < _SUBEXPIRE and not force:
-        return
-
-    cmd = ["jerjerrod", "namesbystatus", "JERJERROD:CHANGED"]
-    _SUB = subprocess.Popen(cmd)
+_REFRESHER = None
+_REFRESHERLOCK = threading.Lock()
 
+_CFGTIME = None
 
-def wsscancount(pl):
-    _refresh(False)
+# all of the wsnames() segments in one render share a single snapshot of
+# every project's status, which is kept for this many seconds
+_SNAPSHOTEXPIRE = 1.0
+_SNAPSHOT = None
+_SNAPSHOTTIME = None
+
+_LOG = logging.getLogger(__name__)
+
+
+def _requires_segment_info(func):
+    # the same as powerline.theme.requires_segment_info, without importing
+    # powerline
+    func.powerline_requires_segment_info = True
+    return func
+
+
+def _getcwd(segment_info):
+    """Returns the cwd of the shell being rendered, if powerline knows it"""
+    getcwd = (segment_info or {}).get("getcwd")
+    if getcwd is None:
+        return None
+    try:
+        return getcwd()
+    except OSError:
+        # the folder may have been deleted
+        return None
+
+
+def _repoerrors(records):
+    """Yields (path, error) for each repo in *records* which couldn't be inspected"""
+    for record in records:
+        for repo in record.get("repos", [record]):
+            if repo.get("error"):
+                yield repo["path"], repo["error"]
+
+
+class _Refresher(object):
+    """
+    Thread which keeps a Scanner up to date, a little at a time, so that the
+    segments can always answer from its latest snapshot straight away.
+    """
+
+    def __init__(self):
+        from jerjerrod.scanner import Scanner
+
+        self.scanner = Scanner()
+        # whether a refresh is inspecting repos right now
+        self.busy = False
+        # how many refreshes in a row have failed
+        self.failures = 0
+        # the traceback of the last failure, until a segment has logged it
+        self.error = None
+        # why repos couldn't be inspected, until a segment has logged it. A
+        # broken repo is only reported again if its error changes.
+        self.repoerrors = []
+        self._knownerrors = {}
+        # the repo containing the cwd of the last shell that was rendered is
+        # refreshed first
+        self.cwd = None
+        self._wakeup = threading.Event()
+        # the first snapshot only reads the cache, so it is quick enough to
+        # take before the first render
+        self.scanner.refresh(budget=0)
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def poke(self):
+        """Start the next refresh now"""
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self.busy = True
+            try:
+                changed = self.scanner.refresh(budget=REFRESH_BUDGET, cwd=self.cwd)
+            except Exception:
+                _LOG.exception("jerjerrod: refreshing projects failed")
+                self.error = traceback.format_exc()
+                self.failures += 1
+                delay = min(_BACKOFF * 2 ** (self.failures - 1), _MAXBACKOFF)
+            else:
+                self.failures = 0
+                records = self.scanner.snapshot().values()
+                self._noteerrors(records)
+                # don't keep going if refreshing isn't getting anywhere, e.g.
+                # because a repo changes faster than it can be inspected
+                if changed and any(record["stale"] for record in records):
+                    delay = _CONTINUE_INTERVAL
+                else:
+                    delay = _REFRESH_INTERVAL
+            finally:
+                self.busy = False
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+
+    def _noteerrors(self, records):
+        errors = dict(_repoerrors(records))
+        for path, error in sorted(errors.items()):
+            if self._knownerrors.get(path) != error:
+                _LOG.warning("jerjerrod: couldn't inspect %s: %s", path, error)
+                self.repoerrors.append("{}: {}".format(path, error))
+        self._knownerrors = errors
+
+
+def _getrefresher(cwd):
+    """*cwd* is the cwd of the shell being rendered, or None if unknown"""
+    global _REFRESHER
+    with _REFRESHERLOCK:
+        if _REFRESHER is None:
+            _REFRESHER = _Refresher()
+            _REFRESHER.cwd = cwd
+            _REFRESHER.start()
+        elif cwd is not None:
+            _REFRESHER.cwd = cwd
+        return _REFRESHER
+
+
+@_requires_segment_info
+def wsscancount(pl, segment_info=None):
+    # a running daemon does its own refreshing
+    if daemon.query("ping"):
+        return []
+
+    refresher = _getrefresher(_getcwd(segment_info))
+    error, refresher.error = refresher.error, None
+    if error is not None and pl is not None:
+        pl.error("refreshing projects failed:\n{}", error)
+    repoerrors, refresher.repoerrors = refresher.repoerrors, []
+    for repoerror in repoerrors:
+        if pl is not None:
+            pl.warn("couldn't inspect {}", repoerror)
 
     ret = []
-    if _SUB is not None:
+    if refresher.failures or refresher.busy:
         ret.append(
             {
-                "contents": "!!!" if _SUB is False else "***",
+                "contents": "!!!" if refresher.failures else "***",
                 "highlight_groups": ["JERJERROD:SCANNING"],
                 #'divider_highlight_group': 'JERJERROD:SEPARATOR',
             }
@@ -60,7 +176,7 @@ _CFGCHECKFREQ = 3
 
 
 def _expirecfgcache():
-    global _CFGCHECKTIME, _CFGCACHE, _CFGTIME
+    global _CFGCHECKTIME, _CFGTIME, _SNAPSHOTTIME
 
     if _CFGCHECKTIME is not None and (time.time() - _CFGCHECKTIME) < _CFGCHECKFREQ:
         return
@@ -69,14 +185,46 @@ def _expirecfgcache():
     _CFGCHECKTIME = time.time()
     mtime = os.stat(RCFILE).st_mtime
 
-    # if the file's mtime is different to last time, we want to destroy our
-    # cache
+    # if the file's mtime is different to last time, the projects need to be
+    # loaded again
     if mtime != _CFGTIME:
+        if _CFGTIME is not None and _REFRESHER is not None:
+            _REFRESHER.poke()
         _CFGTIME = mtime
-        _CFGCACHE = {}
+        # the snapshot might be based on the old config
+        _SNAPSHOTTIME = None
+
 
+def _localsnapshot(cwd):
+    snapshot = {}
+    ignored = getsharedcache().getignorelist()
 
-def wsnames(pl, category):
+    refresher = _getrefresher(cwd)
+    for record in refresher.scanner.snapshot().values():
+        if record["path"] in ignored:
+            continue
+        snapshot.setdefault(record["status"], []).append(record["name"])
+    return snapshot
+
+
+def _getsnapshot(cwd):
+    """Returns a dict mapping each status to the names of projects that have it"""
+    global _SNAPSHOT, _SNAPSHOTTIME
+
+    if _SNAPSHOTTIME is not None and (time.time() - _SNAPSHOTTIME) < _SNAPSHOTEXPIRE:
+        return _SNAPSHOT
+
+    snapshot = daemon.query("snapshot")
+    if snapshot is None:
+        snapshot = _localsnapshot(cwd)
+
+    _SNAPSHOT = snapshot
+    _SNAPSHOTTIME = time.time()
+    return snapshot
+
+
+@_requires_segment_info
+def wsnames(pl, category, segment_info=None):
     _expirecfgcache()
     assert category in (
         "JERJERROD:CHANGED",
@@ -84,18 +232,7 @@ def wsnames(pl, category):
         "JERJERROD:UNPUSHED",
         "JERJERROD:UNKNOWN",
     )
-    names = []
-    cache = DiskCache()
-    ignored = cache.getignorelist()
-
-    for proj in get_all_projects(cache, _CFGCACHE):
-        if proj.project_path in ignored:
-            continue
-        status = proj.getstatus(False)
-        if status == "JERJERROD:UNKNOWN" and _SUB is None:
-            _refresh(True)
-        if status == category:
-            names.append(proj.getname())
+    names = _getsnapshot(_getcwd(segment_info)).get(category, [])
 
     # never show more than 5 names in the 'unknown' category
     count = len(names)
@@ -1,15 +1,19 @@
+# NOTE: this module is imported by the powerline segments and by every CLI
+# command, most of which only read cached records. Anything that is only needed
+# to actually inspect a repo (GitPython, asyncio, subprocess, thread pools) is
+# imported by the function that uses it.
 import os
 import re
+import sys
+import threading
+import time
+import weakref
 from contextlib import contextmanager
 from os.path import join
-from subprocess import STDOUT, CalledProcessError, TimeoutExpired, check_output
-
-import git
-import diskcache
-
-from jerjerrod.caching import OUTGOING_EXPIRY, PROJECT_EXPIRY
-from jerjerrod.config import get_singles, get_workspaces, get_improved_cache
 
+from jerjerrod import tracing
+from jerjerrod.caching import OUTGOING_EXPIRY, PROJECT_EXPIRY, getsharedcache
+from jerjerrod.config import UNTRACKED_MODES, get_singles, get_workspaces
 
 HOME = os.environ["HOME"]
 # allow up to 10 seconds to contact a remote HG server
@@ -18,6 +22,31 @@ HG_REMOTE_TIMEOUT = 10
 # 30 days
 IS_ANCESTOR_CACHE_TIMEOUT = 30 * 24 * 60 * 60
 
+# how many repos may be inspected at the same time
+INSPECT_JOBS = 8
+
+# how many VCS commands the asyncio backend may run at the same time
+ASYNC_MAX_PROCS = 64
+# how long the asyncio backend allows a single VCS command to run
+ASYNC_CMD_TIMEOUT = 60
+
+# one semaphore per event loop, limiting how many VCS commands may be running
+_ASYNC_SEMAPHORES = weakref.WeakKeyDictionary()
+
+# records only keep this many changed/untracked file names, plus the total
+# count. RepoSummary can't fit more than 14 names into its 40 characters anyway.
+RECORD_SAMPLE = 20
+
+# how long `jerjerrod refresh --budget` may spend by default, in seconds
+REFRESH_BUDGET = 2.0
+# how long to remember how long each repo took to inspect
+COST_EXPIRY = 30 * 24 * 60 * 60
+# repos are never expected to be quicker than this to inspect
+MIN_COST = 0.05
+
+# git's version as a tuple of ints, looked up the first time it is needed
+_GIT_VERSION = None
+
 
 @contextmanager
 def gc_(*things):
@@ -27,8 +56,122 @@ def gc_(*things):
         thing.__del__()
 
 
+def _cmdspan(args, cwd):
+    # name the span after the subcommand, skipping any `git -c name=value`
+    idx = 1
+    while list(args[idx : idx + 1]) == ["-c"]:
+        idx += 2
+    name = " ".join([args[0]] + list(args[idx : idx + 1]))
+    return tracing.span(name, tracing.SUBPROCESS, repo=cwd, cmd=args)
+
+
 def cmd2lines(*args, **kwargs):
-    output = check_output(*args, **kwargs)
+    from subprocess import check_output
+
+    with _cmdspan(args[0], kwargs.get("cwd")):
+        output = check_output(*args, **kwargs)
+    yield from _splitlines(output)
+
+
+def streamlines(args, cwd):
+    """Like cmd2lines(), but yields each line as soon as the command prints it"""
+    from subprocess import PIPE, CalledProcessError, Popen
+
+    with _cmdspan(args, cwd), Popen(args, cwd=cwd, stdout=PIPE) as proc:
+        for raw in proc.stdout:
+            line = raw.decode("utf-8").rstrip()
+            if len(line):
+                yield line
+    if proc.returncode:
+        raise CalledProcessError(proc.returncode, args)
+
+
+def _getsemaphore():
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    sem = _ASYNC_SEMAPHORES.get(loop)
+    if sem is None:
+        sem = _ASYNC_SEMAPHORES[loop] = asyncio.Semaphore(ASYNC_MAX_PROCS)
+    return sem
+
+
+async def acheck_output(args, cwd, stderr=None, input=None, timeout=ASYNC_CMD_TIMEOUT):
+    """
+    asyncio equivalent of subprocess.check_output(). Raises the same
+    CalledProcessError and TimeoutExpired exceptions so that callers can share
+    their error handling with the synchronous code.
+    """
+    import asyncio
+    from subprocess import PIPE, CalledProcessError, TimeoutExpired
+
+    stdin = None if input is None else PIPE
+    async with _getsemaphore():
+        with _cmdspan(args, cwd):
+            proc = await asyncio.create_subprocess_exec(
+                *args, cwd=cwd, stdin=stdin, stdout=PIPE, stderr=stderr
+            )
+            try:
+                output, _ = await asyncio.wait_for(proc.communicate(input), timeout)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                raise TimeoutExpired(args, timeout)
+    if proc.returncode:
+        raise CalledProcessError(proc.returncode, args, output=output)
+    return output
+
+
+async def acmd2lines(args, cwd, **kwargs):
+    output = await acheck_output(args, cwd, **kwargs)
+    return list(_splitlines(output))
+
+
+async def astreamlines(args, cwd, timeout=ASYNC_CMD_TIMEOUT):
+    """asyncio equivalent of streamlines()"""
+    import asyncio
+    from subprocess import PIPE, CalledProcessError, TimeoutExpired
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    async with _getsemaphore():
+        with _cmdspan(args, cwd):
+            proc = await asyncio.create_subprocess_exec(*args, cwd=cwd, stdout=PIPE)
+            try:
+                while True:
+                    raw = await asyncio.wait_for(
+                        proc.stdout.readline(), deadline - loop.time()
+                    )
+                    if not raw:
+                        break
+                    line = raw.decode("utf-8").rstrip()
+                    if len(line):
+                        yield line
+                await asyncio.wait_for(proc.wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                raise TimeoutExpired(args, timeout)
+    if proc.returncode:
+        raise CalledProcessError(proc.returncode, args)
+
+
+def gitversion():
+    global _GIT_VERSION
+    if _GIT_VERSION is None:
+        from subprocess import check_output
+
+        output = check_output(["git", "version"]).decode("utf-8")
+        _GIT_VERSION = tuple(int(n) for n in re.findall(r"\d+", output)[:3])
+    return _GIT_VERSION
+
+
+def _hasfsmonitor():
+    # git's builtin fsmonitor daemon arrived in v2.36, for macOS and Windows only
+    return gitversion() >= (2, 36) and sys.platform in ("darwin", "win32")
+
+
+def _splitlines(output):
     for line in output.decode("utf-8").split("\n"):
         line = line.rstrip()
         if len(line):
@@ -36,17 +179,250 @@ def cmd2lines(*args, **kwargs):
 
 
 class Inspector(object):
-    outgoingexpensive = True
+    # whether getremoteoutgoing() can ask the remote repo what is outgoing
+    hasremoteoutgoing = False
 
     def __init__(self, path):
         self._path = path
 
+    def copy(self):
+        """Returns a new Inspector for the same repo, without any cached state"""
+        return self.__class__(self._path)
+
+    @tracing.traced
+    def collect(self, limit=RECORD_SAMPLE):
+        """
+        Returns a dict with the repo's current branch, the number of changed
+        and untracked files along with the names of up to *limit* of each (or
+        all of them if *limit* is None), and number of stashes.
+        """
+        changed = list(self.getchanged())
+        untracked = list(self.getuntracked())
+        return {
+            "branch": self.getbranch(),
+            "changed": changed[:limit],
+            "nchanged": len(changed),
+            "untracked": untracked[:limit],
+            "nuntracked": len(untracked),
+            "stashes": self.getstashcount(),
+        }
+
+    def _fingerprintpaths(self):
+        return [self._path]
+
+    def getmetadirs(self):
+        """Returns the folders containing the paths used by fingerprint()"""
+        dirs = set()
+        for path in self._fingerprintpaths():
+            if not os.path.isdir(path):
+                path = os.path.dirname(path)
+            if os.path.isdir(path):
+                dirs.add(path)
+        return dirs
+
+    @tracing.traced
+    def fingerprint(self):
+        """
+        Returns a cheap summary of the repo's VCS state made from a handful of
+        stat() calls. If it is unchanged since the repo was last inspected,
+        then the cached info for the repo can be trusted.
+
+        NOTE: edits to files in subfolders of the working tree don't touch any
+        of the VCS metadata, so the fingerprint can only make cached info
+        expire sooner, not later.
+        """
+        result = []
+        for path in self._fingerprintpaths():
+            try:
+                st = os.stat(path)
+            except OSError:
+                result.append(None)
+            else:
+                # use a list so it compares equal after a round trip via JSON
+                result.append([st.st_mtime_ns, st.st_ino, st.st_size])
+        return result
+
+    @tracing.atraced
+    async def acollect(self, limit=RECORD_SAMPLE):
+        changed = list(await self.agetchanged())
+        untracked = list(await self.agetuntracked())
+        return {
+            "branch": await self.agetbranch(),
+            "changed": changed[:limit],
+            "nchanged": len(changed),
+            "untracked": untracked[:limit],
+            "nuntracked": len(untracked),
+            "stashes": await self.agetstashcount(),
+        }
+
+    # The a*() methods are the asyncio equivalents of the blocking methods
+    # above them, used when inspecting many repos with the asyncio backend.
+
+    async def agetchanged(self):
+        return (await self.astatuslines())[0]
+
+
+class _PorcelainV2Parser(object):
+    """
+    Incremental parser for the output of
+    `git status --porcelain=v2 --branch --show-stash`, which only keeps the
+    names of the first *limit* changed and untracked files.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.branch = None
+        self.changed = []
+        self.nchanged = 0
+        self.untracked = []
+        self.nuntracked = 0
+        # git only reports the stash count since v2.35, and leaves out the
+        # header entirely when there are no stashes
+        self.stashes = 0 if gitversion() >= (2, 35) else None
+
+    def feed(self, line):
+        if line.startswith("# branch.head "):
+            head = line[14:]
+            self.branch = None if head == "(detached)" else head
+        elif line.startswith("# stash "):
+            self.stashes = int(line[8:])
+        elif line.startswith("# "):
+            # other headers (branch.oid, branch.upstream, ...) aren't needed
+            pass
+        elif line.startswith("? "):
+            self.nuntracked += 1
+            if self._keep(self.untracked):
+                self.untracked.append(line[2:])
+        elif line[:2] in ("1 ", "2 ", "u "):
+            self.nchanged += 1
+            if self._keep(self.changed):
+                self.changed.append(self._changedpath(line))
+        elif not line.startswith("! "):
+            raise Exception("Unexpected: %r" % line)
+
+    def _keep(self, names):
+        return self.limit is None or len(names) < self.limit
+
+    def _changedpath(self, line):
+        if line.startswith("1 "):
+            # 1 XY sub mH mI mW hH hI path
+            return line.split(" ", 8)[8]
+        if line.startswith("2 "):
+            # 2 XY sub mH mI mW hH hI Xscore path<TAB>origPath
+            return line.split(" ", 9)[9].split("\t", 1)[0]
+        # u XY sub m1 m2 m3 mW h1 h2 h3 path
+        return line.split(" ", 10)[10]
+
+    def getinfo(self):
+        return {
+            "branch": self.branch,
+            "changed": self.changed,
+            "nchanged": self.nchanged,
+            "untracked": self.untracked,
+            "nuntracked": self.nuntracked,
+            "stashes": self.stashes,
+        }
+
 
 class GitInspector(Inspector):
     _statuslines = None
-    outgoingexpensive = False
 
+    # when True, collect() gathers everything from a single `git status` call
+    # instead of using the individual get*() methods
+    use_porcelain_v2 = True
+
+    def __init__(self, path, untracked="all"):
+        """*untracked* is the repo's UNTRACKED= flag, one of UNTRACKED_MODES"""
+        super(GitInspector, self).__init__(path)
+        assert untracked in UNTRACKED_MODES
+        self._untracked = untracked
+
+    def copy(self):
+        return self.__class__(self._path, self._untracked)
+
+    def _fingerprintpaths(self):
+        gitdir = join(self._path, ".git")
+        if os.path.isfile(gitdir):
+            # worktrees and submodules have a .git file pointing at the gitdir
+            with open(gitdir) as f:
+                content = f.read().strip()
+            if content.startswith("gitdir: "):
+                gitdir = join(self._path, content[8:])
+
+        # a worktree's refs live in the main repo's gitdir
+        commondir = gitdir
+        if os.path.exists(join(gitdir, "commondir")):
+            with open(join(gitdir, "commondir")) as f:
+                commondir = join(gitdir, f.read().strip())
+
+        paths = [
+            self._path,
+            join(gitdir, "HEAD"),
+            join(gitdir, "index"),
+            join(gitdir, "logs", "HEAD"),
+            join(gitdir, "FETCH_HEAD"),
+            join(commondir, "packed-refs"),
+            join(commondir, "logs", "refs", "stash"),
+        ]
+        # updating a ref only touches the folder it is in, e.g.
+        # refs/remotes/origin after a push or fetch, or refs/heads/feature
+        # after committing to feature/x
+        for top in ("heads", "remotes"):
+            refsdir = join(commondir, "refs", top)
+            paths.append(refsdir)
+            for parent, dirnames, _ in os.walk(refsdir):
+                dirnames.sort()
+                paths.extend(join(parent, name) for name in dirnames)
+        return paths
+
+    def _porcelaincmd(self):
+        cmd = ["git"]
+        if self._untracked in ("cached", "normal"):
+            # the untracked cache lets git skip reading folders which haven't
+            # changed, and fsmonitor lets it skip stat()ing the whole tree
+            cmd += ["-c", "core.untrackedCache=true"]
+            if _hasfsmonitor():
+                cmd += ["-c", "core.fsmonitor=true"]
+        cmd += ["status", "--porcelain=v2", "--branch", "--show-stash"]
+        if self._untracked == "no":
+            cmd.append("--untracked-files=no")
+        elif self._untracked == "normal":
+            # list untracked folders without looking inside them
+            cmd.append("--untracked-files=normal")
+        else:
+            cmd.append("--untracked-files=all")
+        return cmd
+
+    @tracing.traced
+    def collect(self, limit=RECORD_SAMPLE):
+        if not self.use_porcelain_v2:
+            return super(GitInspector, self).collect(limit)
+
+        parser = _PorcelainV2Parser(limit)
+        for line in streamlines(self._porcelaincmd(), self._path):
+            parser.feed(line)
+        info = parser.getinfo()
+        if info["stashes"] is None:
+            info["stashes"] = self.getstashcount()
+        return info
+
+    @tracing.atraced
+    async def acollect(self, limit=RECORD_SAMPLE):
+        if not self.use_porcelain_v2:
+            return await super(GitInspector, self).acollect(limit)
+
+        parser = _PorcelainV2Parser(limit)
+        async for line in astreamlines(self._porcelaincmd(), self._path):
+            parser.feed(line)
+        info = parser.getinfo()
+        if info["stashes"] is None:
+            info["stashes"] = await self.agetstashcount()
+        return info
+
+    @tracing.traced
     def getbranch(self):
+        import git
+
         with gc_(git.Repo(self._path)) as (repo,):
             try:
                 return repo.active_branch.name
@@ -54,185 +430,392 @@ class GitInspector(Inspector):
                 # might be a detached head
                 return None
 
-    def statuslines(self):
+    @tracing.atraced
+    async def agetbranch(self):
+        from subprocess import CalledProcessError
+
+        try:
+            cmd = ["git", "symbolic-ref", "--quiet", "--short", "HEAD"]
+            lines = await acmd2lines(cmd, self._path)
+        except CalledProcessError:
+            # might be a detached head
+            return None
+        return lines[0]
+
+    def _parsestatus(self, lines):
         changedregex = re.compile(r"^(?!  )[RMADUm ]{2} ")
+        changed = []
+        untracked = []
+        for line in lines:
+            if changedregex.match(line[:3]):
+                changed.append(line[3:])
+            elif line[:3] in (" ? ", "?? ", "A? "):
+                untracked.append(line[3:])
+            else:
+                raise Exception("Unexpected: %r" % line)
+        return (changed, untracked)
+
+    @tracing.traced
+    def statuslines(self):
         if self._statuslines is None:
-            changed = []
-            untracked = []
             lines = cmd2lines(["git", "status", "--short"], cwd=self._path)
-            for line in lines:
-                if changedregex.match(line[:3]):
-                    changed.append(line[3:])
-                elif line[:3] in (" ? ", "?? ", "A? "):
-                    untracked.append(line[3:])
-                else:
-                    raise Exception("Unexpected: %r" % line)
-            self._statuslines = (changed, untracked)
+            self._statuslines = self._parsestatus(lines)
+        return self._statuslines
+
+    @tracing.atraced
+    async def astatuslines(self):
+        if self._statuslines is None:
+            lines = await acmd2lines(["git", "status", "--short"], self._path)
+            self._statuslines = self._parsestatus(lines)
         return self._statuslines
 
     def getchanged(self):
         return self.statuslines()[0]
 
+    @tracing.traced
     def getuntracked(self):
+        import git
+
+        if self._untracked == "no":
+            return []
         with gc_(git.Repo(self._path)) as (repo,):
             return repo.untracked_files
 
-    def _is_ancestor(
-        self,
-        repo: git.Repo,
-        ancestor: git.Commit,
-        possible_child: git.Commit,
-        new_cache: diskcache.Cache,
-    ) -> bool:
-        cache_key = (
-            "git_is_ancestor",
-            str(self._path),
-            ancestor.hexsha,
-            possible_child.hexsha,
-        )
-
-        cached = new_cache.get(cache_key)
+    @tracing.atraced
+    async def agetuntracked(self):
+        if self._untracked == "no":
+            return []
+        # this is the same command GitPython uses for Repo.untracked_files
+        cmd = ["git", "status", "--porcelain", "--untracked-files"]
+        lines = await acmd2lines(cmd, self._path)
+        return [line[3:] for line in lines if line.startswith("?? ")]
+
+    def _refscmd(self):
+        fields = ["%(refname)", "%(objectname)", "%(upstream)", "%(upstream:track)"]
+        return [
+            "git",
+            "for-each-ref",
+            "--format=" + "\t".join(fields),
+            "refs/heads",
+            "refs/remotes",
+        ]
+
+    def _parserefs(self, lines):
+        """
+        Returns a tuple of:
+        - the number of local branches which are ahead of their upstream
+        - a dict of {commit: branch name} for local branches with no upstream,
+          excluding those sitting on the same commit as some remote ref
+        - the set of commits that remote refs point at
+        """
+        ahead = 0
+        localonly = {}
+        remoteshas = set()
+        for line in lines:
+            fields = line.split("\t")
+            # trailing empty fields are lost when cmd2lines() strips the line
+            refname, sha, upstream, track = fields + [""] * (4 - len(fields))
+
+            if refname.startswith("refs/remotes/"):
+                remoteshas.add(sha)
+                continue
+
+            # ignore our git-wip backups
+            if ".WIP.BACKUP-" in refname:
+                continue
+
+            # does the local branch have an upstream? Are there any outgoing changes?
+            if upstream and track != "[gone]":
+                if "ahead" in track:
+                    ahead += 1
+                continue
+
+            localonly[sha] = refname[len("refs/heads/") :]
+
+        # forget about the local heads that point at a remote ref's commit - we
+        # know they exist on the remote already
+        for sha in remoteshas:
+            localonly.pop(sha, None)
+
+        return ahead, localonly, remoteshas
+
+    def _pushedkey(self, sha, remoteshas):
+        # whether a commit is contained in a particular set of remote commits
+        # never changes, so it can be cached for a long time
+        import hashlib
+
+        digest = hashlib.sha1(" ".join(sorted(remoteshas)).encode()).hexdigest()
+        return ":".join(["git_pushed", str(self._path), sha, digest])
+
+    def _getpushed(self, localonly, remoteshas, new_cache):
+        """
+        Returns a dict of {commit: bool} saying whether each local-only commit
+        is contained in a remote ref, for those commits where this is cached.
+        """
+        if not remoteshas:
+            # nothing can have been pushed if there are no remote refs
+            return {sha: False for sha in localonly}
 
-        if cached is not None:
-            return cached
+        keys = {self._pushedkey(sha, remoteshas): sha for sha in localonly}
+        cached = new_cache.getvalues(list(keys))
+        return {keys[key]: value for key, value in cached.items()}
 
-        value = repo.is_ancestor(ancestor, possible_child)
-        new_cache.set(cache_key, value, expire=IS_ANCESTOR_CACHE_TIMEOUT)
-        return value
+    def _revlistcmd(self, unknown, remoteshas):
+        """
+        Returns the args and stdin for a `git rev-list` listing every commit
+        reachable from the *unknown* commits but not from any remote ref. A
+        local-only commit has been pushed if and only if it is not listed.
+        """
+        excluded = ["^" + sha for sha in sorted(remoteshas)]
+        stdin = "\n".join(list(unknown) + excluded) + "\n"
+        return ["git", "rev-list", "--stdin"], stdin.encode()
+
+    def _setpushed(self, unknown, remoteshas, unpushed, new_cache):
+        pushed = {sha: sha not in unpushed for sha in unknown}
+        new_cache.setvalues(
+            {self._pushedkey(sha, remoteshas): value for sha, value in pushed.items()},
+            expire=IS_ANCESTOR_CACHE_TIMEOUT,
+        )
+        return pushed
 
-    def getoutgoing(self):
-        outgoing = []
+    def _countoutgoing(self, lines):
+        """
+        Work out the outgoing count from the output of _refscmd(). Returns the
+        `git rev-list` (cmd, stdin) still needed for the commits whose pushed
+        state isn't cached, or None, and a function which takes that
+        command's output and returns the count.
+        """
+        new_cache = getsharedcache()
+        ahead, localonly, remoteshas = self._parserefs(lines)
 
-        new_cache = get_improved_cache()
+        pushed = self._getpushed(localonly, remoteshas, new_cache)
+        unknown = [sha for sha in localonly if sha not in pushed]
 
-        with gc_(git.Repo(self._path)) as (repo,):
-            localonly = {}
-            for head in repo.branches:
-                # ignore our git-wip backups
-                if ".WIP.BACKUP-" in head.name:
-                    continue
-
-                # does the local branch have an upstream? Are there any outgoing changes?
-                upstream = head.tracking_branch()
-
-                if not (upstream and upstream.is_valid()):
-                    localonly[head.commit.binsha] = head
-                    continue
-
-                if head.commit == upstream.commit:
-                    continue
-
-                if not self._is_ancestor(repo, head.commit, upstream.commit, new_cache):
-                    outgoing.append(head)
-
-            # NOTE: the repo object can check if one commit is ancestor of another using is_ancestor()
-            # put all the remote refs in a dict so we can look for local commits that aren't part of any of them
-            remote_refs: Dict[str, git.RemoteReference] = {}
-
-            for remote in repo.remotes:
-                # now go through remote refs and see if our locals have been merged into any of them yet?
-                for ref in remote.refs:
-                    # forget about the local head that pointed at this commit - we know it exists on the remote already
-                    localonly.pop(ref.commit.binsha, None)
-                    remote_refs[ref.name] = ref
-
-            for head in localonly.values():
-                pushed = False
-
-                # there's a few remote refs we should check first
-                priority_refnames = [
-                    refname
-                    for refname in [
-                        "origin/master",
-                        "origin/main",
-                        "origin/{}".format(head.name),
-                    ]
-                    if refname in remote_refs
-                ]
-
-                # make a list of all other refs
-                other_refnames = [
-                    refname
-                    for refname, ref in remote_refs.items()
-                    if refname not in priority_refnames
-                ]
-
-                for refname in priority_refnames + other_refnames:
-                    ref = remote_refs[refname]
-                    if self._is_ancestor(repo, head.commit, ref.commit, new_cache):
-                        pushed = True
-                        break
-                if not pushed:
-                    outgoing.append(head)
+        def finish(revlistlines):
+            if unknown:
+                unpushed = set(revlistlines)
+                pushed.update(self._setpushed(unknown, remoteshas, unpushed, new_cache))
+            return ahead + sum(1 for sha in localonly if not pushed[sha])
 
-        return len(outgoing)
+        revlist = self._revlistcmd(unknown, remoteshas) if unknown else None
+        return revlist, finish
 
+    @tracing.traced
+    def getoutgoing(self):
+        lines = cmd2lines(self._refscmd(), cwd=self._path)
+        revlist, finish = self._countoutgoing(lines)
+        if revlist is None:
+            return finish([])
+        cmd, stdin = revlist
+        return finish(cmd2lines(cmd, cwd=self._path, input=stdin))
+
+    @tracing.atraced
+    async def agetoutgoing(self):
+        lines = await acmd2lines(self._refscmd(), self._path)
+        revlist, finish = self._countoutgoing(lines)
+        if revlist is None:
+            return finish([])
+        cmd, stdin = revlist
+        return finish(await acmd2lines(cmd, self._path, input=stdin))
+
+    @tracing.traced
     def getstashcount(self):
         cmd = ["git", "stash", "list"]
         return len(list(cmd2lines(cmd, cwd=self._path)))
 
+    @tracing.atraced
+    async def agetstashcount(self):
+        cmd = ["git", "stash", "list"]
+        return len(await acmd2lines(cmd, self._path))
+
 
 class HgInspector(Inspector):
     _statuslines = None
+    hasremoteoutgoing = True
+    # run hg commands through the pool of command servers in
+    # jerjerrod.hgserver instead of starting hg every time
+    use_cmdserver = True
+
+    def _fingerprintpaths(self):
+        hgdir = join(self._path, ".hg")
+        return [
+            self._path,
+            join(hgdir, "dirstate"),
+            join(hgdir, "branch"),
+            join(hgdir, "bookmarks"),
+            join(hgdir, "shelved"),
+            join(hgdir, "store", "phaseroots"),
+            join(hgdir, "store", "00changelog.i"),
+            # where the repo's remote is configured
+            join(hgdir, "hgrc"),
+        ]
+
+    def _hg(self, args, **kwargs):
+        """Like check_output(["hg"] + args), but in the repo"""
+        cmd = ["hg"] + args
+        if not self.use_cmdserver:
+            from subprocess import check_output
+
+            with _cmdspan(cmd, self._path):
+                return check_output(cmd, cwd=self._path, **kwargs)
+
+        from jerjerrod.hgserver import getpool
+
+        with _cmdspan(cmd, self._path):
+            return getpool().check_output(args, self._path, **kwargs)
+
+    async def _ahg(self, args, **kwargs):
+        """asyncio equivalent of _hg()"""
+        if not self.use_cmdserver:
+            return await acheck_output(["hg"] + args, self._path, **kwargs)
+
+        import asyncio
+        import functools
+
+        # the command servers are shared with blocking callers, so talk to
+        # them from the default executor's threads
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(self._hg, args, **kwargs)
+        )
+
+    def _hglines(self, args):
+        return list(_splitlines(self._hg(args)))
 
+    async def _ahglines(self, args):
+        return list(_splitlines(await self._ahg(args)))
+
+    @tracing.traced
     def getbranch(self):
-        output = list(cmd2lines(["hg", "branch"], cwd=self._path))[0]
+        output = self._hglines(["branch"])[0]
         assert len(output)
         return output
 
-    def statuslines(self):
+    @tracing.atraced
+    async def agetbranch(self):
+        output = (await self._ahglines(["branch"]))[0]
+        assert len(output)
+        return output
+
+    def _parsestatus(self, lines):
         changedregex = re.compile(r"^[MADR!] ")
+        changed = []
+        untracked = []
+        for line in lines:
+            if changedregex.match(line):
+                changed.append(line[2:])
+            elif line[:2] == "? ":
+                untracked.append(line[2:])
+            else:
+                raise Exception("Unexpected: %s" % line)
+        return (changed, untracked)
+
+    @tracing.traced
+    def statuslines(self):
         if self._statuslines is None:
-            changed = []
-            untracked = []
-            lines = cmd2lines(["hg", "status"], cwd=self._path)
-            for line in lines:
-                if changedregex.match(line):
-                    changed.append(line[2:])
-                elif line[:2] == "? ":
-                    untracked.append(line[2:])
-                else:
-                    raise Exception("Unexpected: %s" % line)
-            self._statuslines = (changed, untracked)
+            lines = self._hglines(["status"])
+            self._statuslines = self._parsestatus(lines)
+        return self._statuslines
+
+    @tracing.atraced
+    async def astatuslines(self):
+        if self._statuslines is None:
+            lines = await self._ahglines(["status"])
+            self._statuslines = self._parsestatus(lines)
         return self._statuslines
 
     def getchanged(self):
         return self.statuslines()[0]
 
+    @tracing.traced
     def getuntracked(self):
         return self.statuslines()[1]
 
+    @tracing.atraced
+    async def agetuntracked(self):
+        return (await self.astatuslines())[1]
+
+    # changesets which haven't been published yet, i.e. draft and secret ones
+    _UNPUBLISHED = ["log", "--rev", "not public()", "--template", "{node}\n"]
+
+    def _hasremote(self, lines):
+        """
+        Whether the output of `hg paths` includes a remote which `hg outgoing`
+        would push to by default.
+        """
+        names = {line.split(" = ", 1)[0] for line in lines}
+        return bool(names & {"default", "default-push"})
+
+    @tracing.traced
     def getoutgoing(self):
         """
-        Returns one of:
-        - An integer showing how many changes are outgoing (possibly 0)
-        - A string describing how many unchanges are outgoing
+        Returns how many changesets haven't been published yet, without
+        contacting the remote. Once pushed to a publishing remote (the
+        default) changesets become public, so this is usually the same as
+        what `hg outgoing` would find.
+
+        A repo without a remote has nowhere to push to, so its drafts aren't
+        outgoing.
+        """
+        if not self._hasremote(self._hglines(["paths"])):
+            return 0
+        return len(self._hglines(self._UNPUBLISHED))
+
+    @tracing.atraced
+    async def agetoutgoing(self):
+        if not self._hasremote(await self._ahglines(["paths"])):
+            return 0
+        return len(await self._ahglines(self._UNPUBLISHED))
+
+    @tracing.traced
+    def getremoteoutgoing(self):
+        """
+        Ask the remote with `hg outgoing`. Returns one of:
+        - 0 if nothing is outgoing, or there is no remote
+        - "1+" if some changes are outgoing
         - "-" if the remote host couldn't be contacted
-        FIXME: would be nice to show something like '3+' if we can't contact
-        the remote server, but know there are 3 draft commits
+        - "?" if the remote didn't answer within HG_REMOTE_TIMEOUT
         """
+        from subprocess import STDOUT, CalledProcessError, TimeoutExpired
+
+        if not self._hasremote(self._hglines(["paths"])):
+            return 0
         try:
-            cmd = ["hg", "outgoing"]
-            check_output(cmd, stderr=STDOUT, cwd=self._path, timeout=HG_REMOTE_TIMEOUT)
+            self._hg(["outgoing"], stderr=STDOUT, timeout=HG_REMOTE_TIMEOUT)
         except TimeoutExpired:
             return "?"
         except CalledProcessError as err:
-            if err.output.endswith(
-                b"abort: error: nodename nor servname provided" b", or not known\n"
-            ):
-                return "-"
-            if err.output.endswith(b"abort: no suitable response from remote hg!\n"):
-                return "-"
-            if err.output.endswith(b"no changes found\n"):
-                return 0
-            print('ERROR: {}'.format(err.output))
-            raise
+            return self._outgoingerror(err)
 
         return "1+"
 
+    def _outgoingerror(self, err):
+        """Interpret a failed "hg outgoing" command"""
+        if err.output.endswith(
+            b"abort: error: nodename nor servname provided" b", or not known\n"
+        ):
+            return "-"
+        if err.output.endswith(b"abort: no suitable response from remote hg!\n"):
+            return "-"
+        if err.output.endswith(b"no changes found\n"):
+            return 0
+        print("ERROR: {}".format(err.output))
+        raise err
+
+    @tracing.traced
     def getstashcount(self):
-        lines = cmd2lines(["hg", "shelve", "--list"], cwd=self._path)
-        return len(list(lines))
+        return len(self._hglines(["shelve", "--list"]))
+
+    @tracing.atraced
+    async def agetstashcount(self):
+        return len(await self._ahglines(["shelve", "--list"]))
+
+
+def _recordinfo(info):
+    """Returns *info* without the fingerprint, which is only for the cache"""
+    if info is None:
+        return None
+    return {key: value for key, value in info.items() if key != "fingerprint"}
 
 
 class Project(object):
@@ -257,13 +840,39 @@ class Project(object):
     def getname(self):
         return self._name
 
+    def containspath(self, path):
+        path = os.path.realpath(path)
+        return path == self._path or path.startswith(self._path.rstrip(os.sep) + os.sep)
+
     def isscanning(self):
         return self._scanning
 
+    def isstale(self):
+        """
+        True if any of the project's repos need to be inspected before their
+        cached info can be trusted again
+        """
+        return any(repo.isstale() for repo in self.getrepos())
+
+    def forget(self):
+        """
+        Forget what is known about the project in memory, so that the next
+        lookup checks the cache and each repo's fingerprint again
+        """
+        for repo in self.getrepos():
+            repo.forget()
+
+    def getrepos(self):
+        return []
+
 
 class Repo(Project):
     _info = None
     _newinfo = None
+    # whether _info came from inspecting the repo rather than from the cache
+    _inspected = False
+    # why the last inspection failed, if it did
+    _error = None
 
     isworkspace = False
     spotlight = False
@@ -272,11 +881,24 @@ class Repo(Project):
         super(Repo, self).__init__(name, path)
         self._insp = inspector
 
+    def _getfresh(self):
+        """
+        Returns the cached info for this repo, as long as it hasn't expired
+        and the repo's fingerprint hasn't changed since it was inspected.
+        """
+        info = self._cache.getcache(self._path, PROJECT_EXPIRY)
+        if info is not None and info.get("fingerprint") == self._insp.fingerprint():
+            return info
+        return None
+
     def _getinfo(self, caninspect):
         if self._info is not None:
             return self._info
+        if self._error is not None:
+            # don't try again until forget()
+            return None
 
-        self._info = self._cache.getcache(self._path, PROJECT_EXPIRY)
+        self._info = self._getfresh()
         if self._info is not None:
             return self._info
 
@@ -286,26 +908,106 @@ class Repo(Project):
         if not caninspect:
             return old
 
-        info = {}
-        info["branch"] = self._insp.getbranch()
-        info["changed"] = list(self._insp.getchanged())
-        info["untracked"] = list(self._insp.getuntracked())
-
-        # NOTE: do we need to use a separate cache for outgoing status?
-        outgoing = self._cache.getcache(self._path + "...outgoing", OUTGOING_EXPIRY)
-        if outgoing is None or not self._insp.outgoingexpensive:
-            outgoing = self._insp.getoutgoing()
-            if outgoing == "?" and old is not None:
-                outgoing = old["outgoing"]
-            else:
-                self._cache.setcache(self._path + "...outgoing", outgoing)
+        self._inspectinfo(RECORD_SAMPLE)
+        return self._info
+
+    def _inspectinfo(self, limit):
+        """
+        Inspect the repo, listing up to *limit* changed and untracked files (or
+        all of them if *limit* is None), and cache its info with a sample of
+        each list. Returns the info with the lists in full.
+        """
+        with tracing.span("getinfo", tracing.REPO, repo=self._path):
+            try:
+                info = self._insp.collect(limit)
+                return self._storeinfo(info, self._insp.getoutgoing())
+            except Exception as err:
+                self._setfailed(err)
+                return None
+
+    async def _agetinfo(self):
+        """asyncio equivalent of _getinfo(True)"""
+        if self._info is None and self._error is None:
+            self._info = self._getfresh()
+        if self._info is not None or self._error is not None:
+            return self._info
 
-        info["outgoing"] = outgoing
-        info["stashes"] = self._insp.getstashcount()
-        self._cache.setcache(self._path, info)
-        self._info = info
+        with tracing.span("getinfo", tracing.REPO, repo=self._path):
+            try:
+                info = await self._insp.acollect()
+                self._storeinfo(info, await self._insp.agetoutgoing())
+            except Exception as err:
+                self._setfailed(err)
+        return self._info
+
+    def _setfailed(self, err):
+        """
+        Remember why inspecting the repo failed, so that one broken repo
+        doesn't stop the others from being inspected. The repo's status is
+        UNKNOWN until forget().
+        """
+        self._error = "{}: {}".format(type(err).__name__, err)
+        self._info = None
+
+    def _storeinfo(self, info, outgoing):
+        """
+        Add the *outgoing* count and fingerprint to the freshly collected
+        *info*, and cache it with a sample of each file list. Returns *info*.
+        """
+        info["outgoing"] = self._withremote(outgoing)
+        # NOTE: the fingerprint is taken after inspecting because `git
+        # status` may rewrite the index
+        info["fingerprint"] = self._insp.fingerprint()
+        sample = dict(
+            info,
+            changed=info["changed"][:RECORD_SAMPLE],
+            untracked=info["untracked"][:RECORD_SAMPLE],
+        )
+        self._cache.setcache(self._path, sample)
+        self._info = sample
+        self._inspected = True
         return info
 
+    def _withremote(self, outgoing):
+        """
+        Combine the locally-counted *outgoing* with the result of the last
+        refreshremote(), if there was one.
+        """
+        if not self._insp.hasremoteoutgoing:
+            return outgoing
+        remote = self._cache.getcache(self._path + "...outgoing", OUTGOING_EXPIRY)
+        if not isinstance(remote, dict) or remote["local"] != outgoing:
+            # never checked, or there have been commits since
+            return outgoing
+        if remote["remote"] == 0:
+            # e.g. drafts which were pushed to a non-publishing remote
+            return 0
+        return outgoing or remote["remote"]
+
+    def askremote(self):
+        """
+        Ask the remote repo which changes are outgoing, and cache the answer
+        for the next inspection. This can take up to HG_REMOTE_TIMEOUT.
+        Returns True if the remote answered.
+        """
+        if not self._insp.hasremoteoutgoing:
+            return False
+        local = self._insp.getoutgoing()
+        remote = self._insp.getremoteoutgoing()
+        # "?" and "-" mean the remote couldn't be asked
+        if remote not in (0, "1+"):
+            return False
+        self._cache.setcache(
+            self._path + "...outgoing", {"local": local, "remote": remote}
+        )
+        return True
+
+    def refreshremote(self):
+        """Like askremote(), but also re-inspect the repo with the answer"""
+        if self.askremote():
+            self.invalidate()
+            self.inspect()
+
     def getstatus(self, caninspect):
         info = self._getinfo(caninspect)
         if info is None:
@@ -319,8 +1021,95 @@ class Repo(Project):
             return "JERJERROD:UNPUSHED"
         return "JERJERROD:CLEAN"
 
-    def containspath(self, path):
-        return os.path.realpath(path).startswith(self._path)
+    def getrepos(self):
+        return [self]
+
+    def getmetadirs(self):
+        return self._insp.getmetadirs()
+
+    def forget(self):
+        self._info = None
+        self._inspected = False
+        self._error = None
+        self._insp = self._insp.copy()
+
+    def invalidate(self):
+        """Forget the repo's info so that the next inspect() re-inspects it"""
+        self.forget()
+        self._cache.clearcache(self._path)
+
+    def inspect(self):
+        """Returns the repo's info, inspecting the repo if the cache is stale"""
+        return self._getinfo(True)
+
+    def isstale(self):
+        # _info is only set once the info is known to be fresh
+        self._getinfo(False)
+        return self._info is None
+
+    def getrecord(self, caninspect):
+        """Returns a JSON-friendly dict describing the repo and its info"""
+        return {
+            "name": self._name,
+            "path": self._path,
+            "isworkspace": False,
+            "status": self.getstatus(caninspect),
+            "info": _recordinfo(self._getinfo(caninspect)),
+            "stale": self.isstale(),
+            "error": self._error,
+        }
+
+    def getsummary(self, caninspect):
+        """
+        Returns a small JSON-friendly dict with the repo's status, branch and
+        counts, and whether they came from the cache
+        """
+        info = self._getinfo(caninspect)
+        summary = {
+            "name": self._name,
+            "path": self._path,
+            "isworkspace": False,
+            "status": self.getstatus(caninspect),
+            "cached": not self._inspected,
+            "branch": None,
+            "changed": 0,
+            "untracked": 0,
+            "stashes": 0,
+            "outgoing": 0,
+            "error": self._error,
+        }
+        if info is not None:
+            summary.update(
+                branch=info["branch"],
+                # older records have complete lists instead of counts
+                changed=info.get("nchanged", len(info["changed"])),
+                untracked=info.get("nuntracked", len(info["untracked"])),
+                stashes=info["stashes"],
+                outgoing=info["outgoing"],
+            )
+        return summary
+
+    def getfullrecord(self):
+        """
+        Like getrecord(True), but listing every changed and untracked file
+        instead of a sample. The full lists aren't cached.
+        """
+        self._getinfo(False)
+        if self._info is None:
+            # stale, so inspect it once with the full lists
+            info = self._inspectinfo(None)
+        else:
+            full = self._insp.collect(limit=None)
+            info = dict(
+                self._info,
+                **{
+                    k: full[k]
+                    for k in ("changed", "nchanged", "untracked", "nuntracked")
+                }
+            )
+        record = self.getrecord(True)
+        record["info"] = _recordinfo(info)
+        return record
 
     def getbranch(self, caninspect):
         info = self._getinfo(caninspect)
@@ -330,20 +1119,28 @@ class Repo(Project):
 class Workspace(Project):
     isworkspace = True
 
-    def __init__(self, name, path, ignore):
+    # the workspace folder isn't listed until something asks for its repos or
+    # garbage
+    _repos = None
+    _garbage = None
+
+    def __init__(self, name, path, ignore, untracked="all"):
         super(Workspace, self).__init__(name, path)
-        # TODO: find repos
-        self._repos = []
-        self._garbage = []
         self._ignore = ignore
-        self._scan()
+        # the UNTRACKED= flag for all of the workspace's git repos
+        self._untracked = untracked
 
     def setcache(self, cache):
         super(Workspace, self).setcache(cache)
-        for repo in self._repos:
+        for repo in self._repos or ():
             repo.setcache(cache)
 
     def _scan(self):
+        # keep the Repo objects from the last scan, along with their info
+        known = {repo.project_path: repo for repo in self._repos or ()}
+        repos = []
+        garbage = []
+
         # is there a virtualenv inside this workspace?
         has_venv = os.path.exists(os.path.join(self._path, "bin", "activate"))
         ignore = self._ignore
@@ -363,20 +1160,27 @@ class Workspace(Project):
             subpath = join(self._path, name)
             inspector = None
             if os.path.isdir(join(subpath, ".git")):
-                inspector = GitInspector(subpath)
+                inspector = GitInspector(subpath, self._untracked)
             elif os.path.isdir(join(subpath, ".hg")):
                 inspector = HgInspector(subpath)
             if inspector is not None:
-                # create a Repo object
-                self._repos.append(Repo(name, subpath, inspector))
+                repo = known.get(subpath)
+                if repo is None or repo._insp.__class__ is not inspector.__class__:
+                    # create a Repo object
+                    repo = Repo(name, subpath, inspector)
+                    repo.setcache(self._cache)
+                repos.append(repo)
             else:
                 # do we need to ignore this thing?
                 if name not in ignore:
-                    self._garbage.append(name)
+                    garbage.append(name)
+
+        self._repos = repos
+        self._garbage = garbage
 
     def getstatus(self, caninspect):
         # return the worst status
-        all_ = set((repo.getstatus(caninspect) for repo in self._repos))
+        all_ = set((repo.getstatus(caninspect) for repo in self.getrepos()))
         for status in (
             "JERJERROD:UNKNOWN",
             "JERJERROD:CHANGED",
@@ -385,43 +1189,164 @@ class Workspace(Project):
         ):
             if status in all_:
                 return status
-        if len(self._garbage):
+        if len(self.getgarbage()):
             return "JERJERROD:GARBAGE"
         return "JERJERROD:CLEAN"
 
+    def getrepos(self):
+        if self._repos is None:
+            self._scan()
+        return self._repos
+
+    def forget(self):
+        # repos may have been added to or removed from the folder
+        if self._repos is not None:
+            self._scan()
+        super(Workspace, self).forget()
+
+    def getrecord(self, caninspect):
+        """Returns a JSON-friendly dict describing the workspace and its repos"""
+        return {
+            "name": self._name,
+            "path": self._path,
+            "isworkspace": True,
+            "status": self.getstatus(caninspect),
+            "repos": [repo.getrecord(caninspect) for repo in self.getrepos()],
+            "garbage": list(self.getgarbage()),
+            "stale": self.isstale(),
+        }
+
+    def getsummary(self, caninspect):
+        """Returns the workspace's status, and the getsummary() of each repo"""
+        repos = [repo.getsummary(caninspect) for repo in self.getrepos()]
+        return {
+            "name": self._name,
+            "path": self._path,
+            "isworkspace": True,
+            "status": self.getstatus(caninspect),
+            "cached": all(repo["cached"] for repo in repos),
+            "repos": repos,
+            "garbage": len(self.getgarbage()),
+        }
+
+    def getfullrecord(self):
+        """Like getrecord(True), but with each repo's getfullrecord()"""
+        # inspect the repos first so getrecord() doesn't inspect them again
+        repos = [repo.getfullrecord() for repo in self.getrepos()]
+        record = self.getrecord(True)
+        record["repos"] = repos
+        return record
+
     def get_branches(self, caninspect):
-        for repo in self._repos:
+        for repo in self.getrepos():
             yield repo.getbranch(caninspect)
 
     def getgarbage(self):
+        if self._garbage is None:
+            self._scan()
         return self._garbage
 
-    def containspath(self, path):
-        return os.path.realpath(path).startswith(self._path)
+
+def _pathparts(path):
+    return [part for part in path.split(os.sep) if part]
+
+
+class ProjectIndex(object):
+    """
+    Finds projects by name or by a path inside them, without scanning any
+    workspace folders. Paths are looked up in a trie of path components, so
+    /src/foo can't be mistaken for part of /src/foobar.
+    """
+
+    def __init__(self, projects):
+        self._projects = list(projects)
+        self._byname = {}
+        # each node is a dict of {path component: child node}, plus the
+        # project found at that path (if any) under the key None
+        self._trie = {}
+        for proj in self._projects:
+            self._byname.setdefault(proj.getname(), []).append(proj)
+            node = self._trie
+            for part in _pathparts(proj.project_path):
+                node = node.setdefault(part, {})
+            node.setdefault(None, proj)
+
+    def __iter__(self):
+        return iter(self._projects)
+
+    def byname(self, name):
+        found = self._byname.get(name)
+        return found[0] if found else None
+
+    def bypath(self, path):
+        """Returns the innermost project containing *path*, or None"""
+        found = None
+        node = self._trie
+        for part in _pathparts(os.path.realpath(path)):
+            node = node.get(part)
+            if node is None:
+                break
+            found = node.get(None, found)
+        return found
+
+    def findall(self, name_or_path):
+        """
+        Returns every project called *name_or_path*, followed by every project
+        containing the path *name_or_path* from the outermost inwards
+        """
+        found = list(self._byname.get(name_or_path, ()))
+        node = self._trie
+        for part in _pathparts(os.path.realpath(name_or_path)):
+            node = node.get(part)
+            if node is None:
+                break
+            if None in node and node[None] not in found:
+                found.append(node[None])
+        return found
+
+    def find(self, name_or_path):
+        """
+        Returns the project named like the last component of *name_or_path*,
+        or failing that the project containing the path *name_or_path*.
+        """
+        return self.byname(os.path.basename(name_or_path)) or self.bypath(name_or_path)
+
+
+def _untrackedflag(flag):
+    mode = flag[10:]
+    if mode not in UNTRACKED_MODES:
+        raise Exception("Invalid flag %r" % (flag,))
+    return mode
 
 
 def get_all_projects(diskcache, memcache):
     for name, path, flags in get_workspaces(memcache):
         ignore = []
+        untracked = "all"
         for flag in flags:
             if flag.startswith("IGNORE="):
                 ignore.append(flag[7:])
+            elif flag.startswith("UNTRACKED="):
+                untracked = _untrackedflag(flag)
             else:
                 raise Exception("Invalid flag %r" % (flag,))
 
-        project = Workspace(name, path, ignore=ignore)
+        project = Workspace(name, path, ignore=ignore, untracked=untracked)
         project.setcache(diskcache)
         yield project
     for name, path, flags in get_singles(memcache):
         spotlight = False
+        untracked = "all"
         for flag in flags:
             if flag == "SPOTLIGHT":
                 spotlight = True
+            elif flag.startswith("UNTRACKED="):
+                untracked = _untrackedflag(flag)
             else:
                 raise Exception("Invalid flag %r" % (flag,))
         # what type of inspector?
         if os.path.exists(join(path, ".git")):
-            inspector = GitInspector(path)
+            inspector = GitInspector(path, untracked)
         elif os.path.isdir(join(path, ".hg")):
             inspector = HgInspector(path)
         else:
@@ -431,3 +1356,198 @@ def get_all_projects(diskcache, memcache):
         if spotlight:
             project.spotlight = True
         yield project
+
+
+@contextmanager
+def _threadpool(jobs):
+    """Inspects repos using a pool of up to *jobs* worker threads"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+
+        def submit(repo):
+            return pool.submit(repo.inspect)
+
+        yield submit
+
+
+@contextmanager
+def _asyncpool(jobs):
+    """
+    Inspects repos using an asyncio event loop running in a single background
+    thread, with at most *jobs* VCS commands running at the same time.
+    """
+    import asyncio
+
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    async def setup():
+        _ASYNC_SEMAPHORES[loop] = asyncio.Semaphore(jobs)
+
+    def submit(repo):
+        return asyncio.run_coroutine_threadsafe(repo._agetinfo(), loop)
+
+    try:
+        asyncio.run_coroutine_threadsafe(setup(), loop).result()
+        yield submit
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+INSPECT_BACKENDS = {
+    "threads": _threadpool,
+    "asyncio": _asyncpool,
+}
+
+
+def iter_inspected(projects, jobs=INSPECT_JOBS, backend="threads", ordered=True):
+    """
+    Yield each of *projects* once every repo belonging to it has been
+    inspected, in their original order, or in the order they finish if
+    *ordered* is False.
+
+    Inspections are spread across the chosen *backend* (see INSPECT_BACKENDS)
+    so slow repos further down the list are already being inspected while we
+    wait for the earlier ones. *jobs* limits how much work the backend does at
+    once.
+    """
+    projects = list(projects)
+    if jobs <= 1 and backend == "threads":
+        # inspect the repos one at a time in this thread
+        for project in projects:
+            for repo in project.getrepos():
+                repo.inspect()
+            yield project
+        return
+
+    with INSPECT_BACKENDS[backend](jobs) as submit:
+        pending = [
+            (project, [submit(repo) for repo in project.getrepos()])
+            for project in projects
+        ]
+        if not ordered:
+            yield from _iter_completed(pending)
+            return
+        for project, futures in pending:
+            for future in futures:
+                # re-raises any exception from the backend
+                future.result()
+            yield project
+
+
+def _iter_completed(pending):
+    from concurrent.futures import as_completed
+
+    owners = {}
+    unfinished = {}
+    for project, futures in pending:
+        if not futures:
+            # e.g. a workspace with no repos in it
+            yield project
+            continue
+        unfinished[project] = len(futures)
+        for future in futures:
+            owners[future] = project
+    for future in as_completed(owners):
+        future.result()
+        project = owners[future]
+        unfinished[project] -= 1
+        if not unfinished[project]:
+            yield project
+
+
+def _costkey(repo):
+    return repo.project_path + "...cost"
+
+
+def schedule_refresh(repos, cache, cwd=None):
+    """
+    Returns [(repo, expected seconds)] for each of *repos* which is stale, the
+    most urgent first: the repo containing *cwd*, then SPOTLIGHT repos, then
+    the rest by how long ago they were inspected relative to how long that
+    takes, so that slow repos are refreshed less often than quick ones.
+    """
+    import statistics
+
+    stale = [repo for repo in repos if repo.isstale()]
+    costs = cache.getvalues([_costkey(repo) for repo in stale])
+    # guess that repos which have never been timed are typical
+    guess = max(statistics.median(costs.values()), MIN_COST) if costs else MIN_COST
+    now = time.time()
+
+    def urgency(item):
+        repo, cost = item
+        stored = cache.getstoredtime(repo.project_path)
+        # repos which have never been inspected come first
+        age = float("inf") if stored is None else now - stored
+        return (
+            cwd is None or not repo.containspath(cwd),
+            not repo.spotlight,
+            -age / max(cost, MIN_COST),
+        )
+
+    return sorted(
+        [(repo, costs.get(_costkey(repo), guess)) for repo in stale], key=urgency
+    )
+
+
+def refresh_within(
+    repos, budget, cache, jobs=INSPECT_JOBS, backend="threads", cwd=None
+):
+    """
+    Inspect the stale repos among *repos* in schedule_refresh() order until
+    *budget* seconds are used up, and return how many were inspected.
+
+    A repo isn't started if it is expected to take longer than what is left of
+    the budget, unless nothing else has been started yet. Repos which are
+    still being inspected when the budget runs out are left to finish, since
+    stopping git part way could leave its index.lock behind. Each repo's
+    record is saved as soon as it has been inspected, along with how long it
+    took, so the next call carries on where this one left off.
+    """
+    from concurrent.futures import FIRST_COMPLETED, wait
+
+    jobs = max(jobs, 1)
+    deadline = time.monotonic() + budget
+    queue = schedule_refresh(repos, cache, cwd)
+    queue.reverse()
+    # the repos whose cost is known rather than guessed
+    timed = cache.getvalues([_costkey(repo) for repo, _ in queue])
+    # future => (repo, expected cost, start time)
+    running = {}
+    costs = {}
+    with INSPECT_BACKENDS[backend](jobs) as submit:
+        try:
+            while queue or running:
+                if time.monotonic() >= deadline:
+                    queue = []
+                while queue and len(running) < jobs:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        queue = []
+                        break
+                    repo, cost = queue.pop()
+                    if cost > remaining and (running or costs):
+                        continue
+                    running[submit(repo)] = (repo, cost, time.monotonic())
+                if not running:
+                    break
+                # wake up when the budget runs out to stop starting new repos
+                timeout = max(deadline - time.monotonic(), 0) if queue else None
+                done, _ = wait(running, timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    repo, cost, started = running.pop(future)
+                    # re-raises any exception from the backend
+                    future.result()
+                    took = time.monotonic() - started
+                    # smooth out the odd unusually slow or quick inspection
+                    key = _costkey(repo)
+                    costs[key] = (cost + took) / 2 if key in timed else took
+        finally:
+            if costs:
+                cache.setvalues(costs, COST_EXPIRY)
+    return len(costs)
@@ -0,0 +1,152 @@
+"""
+Scanner keeps everything jerjerrod knows about your projects in memory between
+calls, for long-running programs such as `jerjerrod daemon`, the powerline
+segments or an editor plugin:
+
+    scanner = Scanner()
+    scanner.refresh()
+    for path, record in scanner.snapshot().items():
+        ...
+    # later, when something says the repo at PATH has changed
+    scanner.refresh([PATH])
+
+The Project objects (and their inspectors) are only rebuilt when the config
+changes, so a refresh() only costs a fingerprint check per repo unless repos
+have actually changed.
+"""
+
+import logging
+import os
+import threading
+
+from jerjerrod.caching import getsharedcache
+from jerjerrod.config import get_singles, get_workspaces
+from jerjerrod.projects import (
+    INSPECT_JOBS,
+    ProjectIndex,
+    get_all_projects,
+    iter_inspected,
+    refresh_within,
+)
+
+_LOG = logging.getLogger(__name__)
+
+
+class Scanner(object):
+    # the config that the projects were built from
+    _config = None
+
+    def __init__(self, cache=None, jobs=INSPECT_JOBS, backend="threads"):
+        self._cache = cache or getsharedcache()
+        self._jobs = jobs
+        self._backend = backend
+        self._lock = threading.Lock()
+        # a ProjectIndex, and a dict of each project's record keyed by its
+        # path. These are replaced together so readers never see half of a
+        # refresh.
+        self._state = (ProjectIndex(()), {})
+
+    def _loadprojects(self, index):
+        memcache = {}
+        config = (get_workspaces(memcache), get_singles(memcache))
+        if config != self._config:
+            index = ProjectIndex(get_all_projects(self._cache, memcache))
+            self._config = config
+        return index
+
+    def refresh(self, paths=None, budget=None, cwd=None):
+        """
+        Re-inspect the repos at *paths*, e.g. after a file watcher has seen
+        them change. Without *paths*, re-read the config and check every repo,
+        which only inspects the repos whose cached info has expired or whose
+        fingerprint has changed.
+
+        With a *budget*, only spend that many seconds inspecting the stale
+        repos which most need it (see refresh_within()), and leave the rest
+        for the next refresh(). A budget of 0 only reads the cache.
+
+        Returns the paths of the projects whose records have changed.
+        """
+        with self._lock:
+            index, records = self._state
+            if paths is None:
+                # pick up records written by other processes
+                self._cache.loadall()
+                index = self._loadprojects(index)
+                projects = list(index)
+                for proj in projects:
+                    proj.forget()
+                newrecords = {}
+            else:
+                # configured paths may go through symlinks, so compare real paths
+                wanted = set(map(os.path.realpath, paths))
+                projects = []
+                for proj in index:
+                    repos = [
+                        r
+                        for r in proj.getrepos()
+                        if os.path.realpath(r.project_path) in wanted
+                    ]
+                    for repo in repos:
+                        repo.invalidate()
+                    if repos:
+                        projects.append(proj)
+                newrecords = dict(records)
+
+            if budget is None:
+                for _ in iter_inspected(projects, self._jobs, self._backend):
+                    pass
+            elif budget > 0:
+                repos = [repo for proj in projects for repo in proj.getrepos()]
+                refresh_within(
+                    repos, budget, self._cache, self._jobs, self._backend, cwd
+                )
+            for proj in projects:
+                newrecords[proj.project_path] = proj.getrecord(False)
+            self._state = (index, newrecords)
+
+        return [
+            path
+            for path in set(records) | set(newrecords)
+            if records.get(path) != newrecords.get(path)
+        ]
+
+    def refreshremote(self):
+        """
+        Ask the remotes of the hg repos what is outgoing (see
+        Repo.askremote()), and then refresh the repos whose remotes answered.
+        Slow, since each remote may take up to HG_REMOTE_TIMEOUT.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        def askremote(repo):
+            try:
+                return repo.askremote()
+            except Exception:
+                _LOG.exception("asking the remote of %s failed", repo.project_path)
+                return False
+
+        repos = self.getrepos()
+        with ThreadPoolExecutor(max_workers=self._jobs) as pool:
+            answered = list(pool.map(askremote, repos))
+        paths = [repo.project_path for repo, ok in zip(repos, answered) if ok]
+        if paths:
+            self.refresh(paths)
+
+    def snapshot(self):
+        """
+        Returns a dict of each project's record (see Project.getrecord()),
+        keyed by the project's path, as of the last refresh(). The dict must
+        not be modified.
+        """
+        return self._state[1]
+
+    def find(self, name_or_path):
+        """Returns the record of the project called or containing *name_or_path*"""
+        index, records = self._state
+        project = index.find(name_or_path)
+        return None if project is None else records.get(project.project_path)
+
+    def getrepos(self):
+        """Returns the Repo objects of every project"""
+        return [repo for proj in self._state[0] for repo in proj.getrepos()]
@@ -0,0 +1,198 @@
+"""
+Optional timing instrumentation for repo inspection and the disk cache.
+
+Tracing is off unless enable() has been called (e.g. by `jerjerrod --trace`),
+and span() costs a single global lookup while it is off. Each span records
+its name, category, start time, duration and the repo it was working on.
+
+NOTE: this module is imported by the powerline segments, so it must not import
+anything expensive.
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+TRACE_FORMATS = ("jsonl", "chrome")
+
+# categories of span
+REPO = "repo"
+INSPECT = "inspect"
+SUBPROCESS = "subprocess"
+CACHE = "cache"
+
+_TRACER = None
+_NULL = nullcontext()
+
+
+class Tracer(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self.events = []
+
+    def add(self, name, cat, start, duration, args):
+        event = {
+            "name": name,
+            "cat": cat,
+            "start": start - self._start,
+            "duration": duration,
+            "thread": threading.get_ident(),
+        }
+        event.update(args)
+        with self._lock:
+            self.events.append(event)
+
+    def dump(self, f, format="jsonl"):
+        if format == "jsonl":
+            for event in self.events:
+                f.write(json.dumps(event) + "\n")
+        elif format == "chrome":
+            json.dump({"traceEvents": self._chromeevents()}, f)
+        else:
+            raise Exception("Unknown trace format {!r}".format(format))
+
+    def _chromeevents(self):
+        # give each repo its own row so that the asyncio backend's interleaved
+        # spans still nest properly
+        rows = {}
+        pid = os.getpid()
+        result = []
+        for event in self.events:
+            repo = event.get("repo")
+            if repo is None:
+                tid = event["thread"]
+            elif repo in rows:
+                tid = rows[repo]
+            else:
+                tid = rows[repo] = len(rows) + 1
+                result.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": pid,
+                        "tid": tid,
+                        "args": {"name": repo},
+                    }
+                )
+            result.append(
+                {
+                    "name": event["name"],
+                    "cat": event["cat"],
+                    "ph": "X",
+                    "ts": event["start"] * 1e6,
+                    "dur": event["duration"] * 1e6,
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {
+                        k: v
+                        for k, v in event.items()
+                        if k not in ("name", "cat", "start", "duration", "thread")
+                    },
+                }
+            )
+        return result
+
+    def summarise(self, limit=10):
+        """
+        Returns a list of lines describing the slowest repos and the overall
+        subprocess and cache counts.
+        """
+        repos = {}
+        for event in self.events:
+            repo = event.get("repo")
+            if repo is None:
+                continue
+            stats = repos.setdefault(repo, {"total": 0.0, "subprocesses": 0, "ops": {}})
+            if event["cat"] == REPO:
+                stats["total"] += event["duration"]
+            elif event["cat"] == SUBPROCESS:
+                stats["subprocesses"] += 1
+            elif event["cat"] == INSPECT:
+                ops = stats["ops"]
+                ops[event["name"]] = ops.get(event["name"], 0.0) + event["duration"]
+
+        lines = ["slowest repos:"]
+        inspected = [item for item in repos.items() if item[1]["total"]]
+        inspected.sort(key=lambda item: -item[1]["total"])
+        for repo, stats in inspected[:limit]:
+            ops = sorted(stats["ops"].items(), key=lambda item: -item[1])
+            lines.append(
+                "  {:8.1f}ms  {} ({} subprocesses) {}".format(
+                    stats["total"] * 1000,
+                    repo,
+                    stats["subprocesses"],
+                    ", ".join("{} {:.1f}ms".format(n, d * 1000) for n, d in ops),
+                )
+            )
+
+        hits = sum(e.get("hits", 0) for e in self.events if e["cat"] == CACHE)
+        misses = sum(e.get("misses", 0) for e in self.events if e["cat"] == CACHE)
+        subprocesses = sum(1 for e in self.events if e["cat"] == SUBPROCESS)
+        lines.append(
+            "{} repos inspected, {} subprocesses, {} cache hits, {} cache misses".format(
+                len(inspected),
+                subprocesses,
+                hits,
+                misses,
+            )
+        )
+        return lines
+
+
+def enable():
+    """Start recording spans in this process, and return the Tracer"""
+    global _TRACER
+    if _TRACER is None:
+        _TRACER = Tracer()
+    return _TRACER
+
+
+def gettracer():
+    """Returns the Tracer, or None if tracing isn't enabled"""
+    return _TRACER
+
+
+@contextmanager
+def _span(tracer, name, cat, args):
+    start = time.perf_counter()
+    try:
+        yield args
+    finally:
+        tracer.add(name, cat, start, time.perf_counter() - start, args)
+
+
+def span(name, cat, **args):
+    """
+    Context manager which records how long its body takes. It yields a dict of
+    *args* which the body may add more details to before the span ends (or
+    None when tracing is off).
+    """
+    if _TRACER is None:
+        return _NULL
+    return _span(_TRACER, name, cat, args)
+
+
+def traced(method):
+    """Decorator recording a span for each call to an Inspector method"""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with span(method.__name__, INSPECT, repo=self._path):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def atraced(method):
+    """Same as traced(), but for async methods"""
+
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        with span(method.__name__, INSPECT, repo=self._path):
+            return await method(self, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,182 @@
+"""
+Watch repos with inotify so that they can be re-inspected as soon as they
+change, instead of waiting for the next full rescan. Linux only.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+import traceback
+
+# how long a repo must be quiet before it is re-inspected
+DEBOUNCE = 0.5
+# don't watch more than this many working tree folders per repo
+MAX_DIRS_PER_REPO = 5000
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+_MASK = (
+    IN_MODIFY
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_ONLYDIR
+)
+_EVENT = struct.Struct("iIII")
+_VCSDIRS = (".git", ".hg")
+
+
+def _walk(path, limit):
+    """Yields up to *limit* folders of the working tree at *path*"""
+    count = 0
+    for dirpath, dirnames, _ in os.walk(path):
+        if count >= limit:
+            return
+        dirnames[:] = [name for name in dirnames if name not in _VCSDIRS]
+        yield dirpath
+        count += 1
+
+
+class Watcher(object):
+    """
+    Calls *callback* with a repo's path once the repo has stopped changing for
+    *debounce* seconds. Events that arrive while the callback is running for a
+    repo are ignored, since inspecting a repo may touch its VCS metadata.
+    """
+
+    def __init__(self, callback, debounce=DEBOUNCE):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise Exception("inotify is not available on this platform")
+        self._libc = libc
+        self._fd = libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        self._callback = callback
+        self._debounce = debounce
+        self._lock = threading.Lock()
+        # wd => (repo path, watched folder)
+        self._wds = {}
+        # repo path => set of wds
+        self._repowds = {}
+        # repo path => time of the most recent event
+        self._pending = {}
+        self._busy = set()
+
+    def start(self):
+        threading.Thread(target=self._readloop, daemon=True).start()
+        threading.Thread(target=self._debounceloop, daemon=True).start()
+
+    def setrepos(self, repos):
+        """
+        Watch exactly the repos in *repos*, a dict mapping each repo's path to
+        the folders of VCS metadata that need to be watched for it.
+        """
+        with self._lock:
+            for path in set(self._repowds) - set(repos):
+                for wd in self._repowds.pop(path):
+                    self._libc.inotify_rm_watch(self._fd, wd)
+                    self._wds.pop(wd, None)
+
+            added = [path for path in repos if path not in self._repowds]
+            for path in added:
+                self._repowds[path] = set()
+                for folder in repos[path]:
+                    self._addwatch(path, folder)
+            # watch every repo's metadata before any working trees, so that
+            # running out of watches only costs some working tree events
+            for path in added:
+                for folder in _walk(path, MAX_DIRS_PER_REPO):
+                    self._addwatch(path, folder)
+
+    def _addwatch(self, repopath, folder):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(folder), _MASK)
+        if wd < 0:
+            # most likely ENOSPC because fs.inotify.max_user_watches has been
+            # reached. The repo will still be picked up by full rescans.
+            return
+        self._wds[wd] = (repopath, folder)
+        self._repowds[repopath].add(wd)
+
+    def _readloop(self):
+        while True:
+            select.select([self._fd], [], [])
+            data = os.read(self._fd, 64 * 1024)
+            now = time.time()
+            with self._lock:
+                offset = 0
+                while offset < len(data):
+                    wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                    offset += _EVENT.size
+                    name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+                    offset += length
+                    self._handle(wd, mask, name, now)
+
+    def _handle(self, wd, mask, name, now):
+        if wd not in self._wds:
+            return
+        repopath, folder = self._wds[wd]
+        if mask & IN_IGNORED:
+            # the folder was deleted
+            del self._wds[wd]
+            self._repowds[repopath].discard(wd)
+            return
+        if name.endswith(".lock"):
+            # git and hg lock files come and go while other things happen
+            return
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            self._watchnew(repopath, folder, name)
+        if repopath not in self._busy:
+            self._pending[repopath] = now
+
+    def _watchnew(self, repopath, folder, name):
+        """Watch the new folder *name* in *folder*, and any folders inside it"""
+        if name in _VCSDIRS:
+            return
+        parts = os.path.relpath(folder, repopath).split(os.sep)
+        if not any(part in _VCSDIRS for part in parts):
+            limit = MAX_DIRS_PER_REPO - len(self._repowds[repopath])
+        elif "refs" in parts:
+            # e.g. refs/remotes/upstream after adding a remote, which the
+            # fingerprint will include from now on
+            limit = MAX_DIRS_PER_REPO
+        else:
+            return
+        # the folder may have been created along with folders inside it, e.g.
+        # by `mkdir -p` or a checkout
+        for subfolder in _walk(os.path.join(folder, name), limit):
+            self._addwatch(repopath, subfolder)
+
+    def _debounceloop(self):
+        while True:
+            time.sleep(self._debounce / 2)
+            cutoff = time.time() - self._debounce
+            with self._lock:
+                due = [path for path, when in self._pending.items() if when < cutoff]
+                for path in due:
+                    del self._pending[path]
+                    self._busy.add(path)
+            for path in due:
+                try:
+                    self._callback(path)
+                except Exception:
+                    traceback.print_exc()
+                with self._lock:
+                    self._busy.discard(path)